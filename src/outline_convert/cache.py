@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+
+def cache_dir(*parts: str) -> str:
+    '''
+    Directory for outline-convert's persistent caches:
+    $OUTLINE_CONVERT_CACHE, else $XDG_CACHE_HOME/outline-convert, else ~/.cache/outline-convert
+    '''
+    base = os.getenv("OUTLINE_CONVERT_CACHE")
+    if not base:
+        base = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                            "outline-convert")
+    return os.path.join(base, *parts)
+
+
+def write_atomic(path: str, data: bytes):
+    '''Write data to path through a temporary file, so readers never see a partial file.'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ResponseCache:
+    '''
+    Content addressed store for AI prompt responses: one file per (model, prompt), named after
+    their sha256.  Reading an entry refreshes its mtime, which evict() uses to drop entries older
+    than max_age seconds and then the least recently used ones until the cache fits in max_bytes.
+    put() leaves a WRITTEN marker in the directory, so that evict_written() only walks the cache
+    after runs that added to it.
+    The cache is best-effort: when the directory cannot be written, put() and the evictions do
+    nothing (and say so on stderr if debug is set), the conversion goes on without it.
+    '''
+
+    WRITTEN = 'written'
+
+    def __init__(self, directory: str, max_bytes: int = 100 * 2**20, max_age: float = 90 * 24 * 3600,
+                 debug: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.debug = debug
+
+    def warn(self, what: str, e: OSError):
+        if self.debug:
+            print(f"AI answer cache: cannot {what} in {self.directory}: {e}", file=sys.stderr)
+
+    def path(self, model: str, prompt: str) -> str:
+        key = hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        path = self.path(model, prompt)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, 'rb') as f:
+                response = f.read().decode('utf-8')
+            os.utime(path)
+        except OSError:
+            return None
+        return response
+
+    def put(self, model: str, prompt: str, response: str):
+        try:
+            write_atomic(self.path(model, prompt), response.encode('utf-8'))
+            with open(os.path.join(self.directory, self.WRITTEN), 'wb'):
+                pass
+        except OSError as e:
+            self.warn("store an answer", e)
+
+    def evict_written(self):
+        '''evict() if entries were put since the last time; of concurrent callers only one evicts.'''
+        try:
+            os.remove(os.path.join(self.directory, self.WRITTEN))
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            self.warn("evict", e)
+            return
+        self.evict()
+
+    def evict(self):
+        try:
+            self.evict_entries()
+        except OSError as e:
+            self.warn("evict", e)
+
+    def evict_entries(self):
+        # other processes may evict the same entries at the same time
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path == os.path.join(self.directory, self.WRITTEN):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.max_age:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                else:
+                    entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ZipIndex:
+    '''
+    Member lists of zip archives, kept in a JSON file and keyed on the archive path, mtime and
+    size, so that an archive is only opened when it is new or has changed.
+    Files that are not valid zip archives are recorded too, with no member list.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.entries: Dict[str, list] = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        self.changed = False
+
+    def members(self, path: str, st: os.stat_result) -> Optional[List[str]]:
+        '''The member names of the archive at path (st is its stat), None if it is not a zip file.'''
+        import zipfile
+
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        try:
+            with zipfile.ZipFile(path) as archive:
+                members = archive.namelist()
+        except (zipfile.BadZipFile, OSError):
+            members = None
+        self.entries[key] = [st.st_mtime_ns, st.st_size, members]
+        self.changed = True
+        return members
+
+    def save(self, directory: str, names: Set[str]):
+        '''Write the index back, forgetting the archives of directory whose name is not in names any more.'''
+        directory = os.path.abspath(directory)
+        for key in [key for key in self.entries
+                    if os.path.dirname(key) == directory and os.path.basename(key) not in names]:
+            del self.entries[key]
+            self.changed = True
+        if self.changed:
+            write_atomic(self.path, json.dumps(self.entries).encode('utf-8'))
+            self.changed = False
+
+
+class LRU(OrderedDict):
+    '''Dictionary that drops its least recently used entries beyond maxsize.'''
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
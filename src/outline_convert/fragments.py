@@ -0,0 +1,168 @@
+import argparse
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
+
+from .models import Node
+
+# a line of output, or the arguments for rendering a pending subtree
+Entry = Union[str, Tuple]
+
+# options that do not change the output of a renderer, see fragment_memo
+NON_RENDER_OPTIONS = {'input', 'output', 'dir', 'clipboard', 'wait', 'date', 'z', 'inputs', 'manifest',
+                      'formats', 'debug', 'test', 'jobs', 'ai_concurrency', 'no_ai_cache'}
+
+# only subtrees of at least FRAGMENT_MIN_SIZE nodes are memoized, and only in the
+# FRAGMENT_LEVELS outermost memoized levels, so that every line is kept a bounded
+# number of times, even for very deep outlines
+FRAGMENT_MIN_SIZE = 16
+FRAGMENT_LEVELS = 3
+
+
+# id(node) -> (node, digest, subtree size), for the subtrees that can be memoized: the nodes do
+# not carry these, only serve renders with FRAGMENTS enabled need them.  Holding the node keeps
+# its id from being reused; the table is emptied beyond DIGESTS_MAX entries
+DIGESTS: Dict[int, Tuple[Node, int, int]] = {}
+DIGESTS_MAX = 100000
+
+
+def subtree_digest(node: Node) -> Tuple[int, int]:
+    '''
+    Content hash of the subtree of node, from its title, note and style and the hashes of its
+    children, and its number of nodes.  Those of subtrees of at least FRAGMENT_MIN_SIZE nodes
+    are kept in DIGESTS, so the walk stops there the next time; digests are computed at render
+    time, once the tree is no longer modified.
+    '''
+    known = DIGESTS.get(id(node))
+    if known is not None:
+        return known[1], known[2]
+    if len(DIGESTS) > DIGESTS_MAX:
+        DIGESTS.clear()
+    # pre-order, so that in reverse every node comes after its children
+    order = []
+    nodeStack = [node]
+    while nodeStack:
+        currentNode = nodeStack.pop()
+        if id(currentNode) not in DIGESTS:
+            order.append(currentNode)
+            nodeStack.extend(currentNode.children)
+    computed: Dict[int, Tuple[int, int]] = {}
+    for currentNode in reversed(order):
+        children = currentNode.children
+        if children:
+            parts = [computed.get(id(child)) or DIGESTS[id(child)][1:] for child in children]
+            digest = hash((currentNode.title, currentNode.note, currentNode.style,
+                           *[part[0] for part in parts]))
+            size = 1 + sum([part[1] for part in parts])
+        else:
+            digest = hash((currentNode.title, currentNode.note, currentNode.style))
+            size = 1
+        computed[id(currentNode)] = digest, size
+        if size >= FRAGMENT_MIN_SIZE:
+            DIGESTS[id(currentNode)] = currentNode, digest, size
+    return computed[id(node)]
+
+
+def fragment_memo(renderer: str, args: argparse.Namespace) -> Optional[Tuple[str, Hashable]]:
+    '''The memo argument of iter_entries for renderer, None unless FRAGMENTS is enabled.'''
+    if not FRAGMENTS.enabled:
+        return None
+    options = tuple(sorted((name, value) for name, value in vars(args).items()
+                           if name not in NON_RENDER_OPTIONS))
+    return renderer, options
+
+
+class FragmentCache:
+    '''
+    Rendered lines of subtrees, keyed on the renderer, the subtree digest, its position (the
+    arguments of the pending entry) and the render options, least recently used ones dropped
+    beyond max_lines lines in total.
+    The cache lives as long as the process, which outline-convert serve keeps running: after a
+    small edit only the subtrees that changed are rendered again.  A single conversion only
+    pays for hashing and recording, so the cache is off unless enabled.
+    '''
+
+    def __init__(self, max_lines: int = 2000000, enabled: bool = False):
+        self.enabled = enabled
+        self.max_lines = max_lines
+        self.lines = 0
+        self.fragments: 'OrderedDict[Hashable, List[str]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[List[str]]:
+        lines = self.fragments.get(key)
+        if lines is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.fragments.move_to_end(key)
+        return lines
+
+    def put(self, key: Hashable, lines: List[str]):
+        if key in self.fragments:
+            self.lines -= len(self.fragments.pop(key))
+        self.fragments[key] = lines
+        self.lines += len(lines)
+        while self.lines > self.max_lines:
+            _, dropped = self.fragments.popitem(last=False)
+            self.lines -= len(dropped)
+
+    def report(self) -> str:
+        '''Hit and miss counts since the last report.'''
+        counts = f"fragments: {self.hits} reused, {self.misses} rendered"
+        self.hits = self.misses = 0
+        return counts
+
+
+FRAGMENTS = FragmentCache()
+
+
+def iter_entries(entries: List[Entry], expand: Callable[..., List[Entry]],
+                 memo: Optional[Tuple[str, Hashable]] = None) -> Iterator[str]:
+    '''
+    Flatten nested rendering without recursion, so that very deep outlines are fine.
+    entries holds output lines (str) and pending subtrees (tuples of arguments for expand,
+    the first one being the node); expand returns the entries of one subtree, which take
+    the place of the tuple.  A pending entry whose node is None is not a subtree: it stands for
+    lines that expand builds only when they are reached, such as closing tags, and is not memoized.
+    Lines are yielded as soon as they are reached, nothing is accumulated, unless memo is
+    given: memo = (renderer name, render options) looks pending subtrees up in FRAGMENTS
+    and records the lines of the subtrees that were not found there.
+    '''
+    if memo is None:
+        stack = list(reversed(entries))
+        while stack:
+            entry = stack.pop()
+            if isinstance(entry, str):
+                yield entry
+            else:
+                stack.extend(reversed(expand(*entry)))
+        return
+
+    _END = None   # end of a recorded subtree
+    stack: List[Optional[Entry]] = list(reversed(entries))
+    recording: List[Tuple[Hashable, List[str]]] = []
+    while stack:
+        entry = stack.pop()
+        if isinstance(entry, str):
+            for _, lines in recording:
+                lines.append(entry)
+            yield entry
+        elif entry is _END:
+            key, lines = recording.pop()
+            FRAGMENTS.put(key, lines)
+        else:
+            node = entry[0]
+            if node is not None and len(recording) < FRAGMENT_LEVELS:
+                digest, size = subtree_digest(node)
+                if size >= FRAGMENT_MIN_SIZE:
+                    key = (memo, digest, entry[1:])
+                    lines = FRAGMENTS.get(key)
+                    if lines is not None:
+                        for _, outer in recording:
+                            outer.extend(lines)
+                        yield from lines
+                        continue
+                    recording.append((key, []))
+                    stack.append(_END)
+            stack.extend(reversed(expand(*entry)))
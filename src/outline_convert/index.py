@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import os
+import pickle
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional
+
+from .cache import cache_dir, write_atomic
+from .models import Node
+from .utils import is_ignored_item, is_ignored_outline
+
+# bump when the parsers or the index layout change, older indexes are then rebuilt
+INDEX_VERSION = 1
+
+
+class OutlineIndex:
+    '''
+    Flat copy of a parsed forest for --start and --filter lookups without parsing the input again.
+    Nodes are numbered in document order (pre-order), so the subtree of node i is the range
+    i..ends[i]-1; parents[i] is -1 for roots.  sorted_ids orders the nodes by title, for prefix
+    lookups by bisection.  Only the nodes that are needed are turned back into Node objects.
+    '''
+
+    def __init__(self, titles: List[str], notes: List[Optional[str]], parents: array, ends: array):
+        self.titles = titles
+        self.notes = notes
+        self.parents = parents
+        self.ends = ends
+        self.sorted_ids = array('l', sorted(range(len(titles)), key=titles.__getitem__))
+        self.sorted_titles = [titles[i] for i in self.sorted_ids]
+
+    @classmethod
+    def from_forest(cls, forest: List[Node]) -> 'OutlineIndex':
+        '''Index the forest as parsed, before preprocessing changes it.'''
+        titles: List[str] = []
+        notes: List[Optional[str]] = []
+        parents = array('l')
+        ends = array('l')
+        nodeStack = [(tree, -1) for tree in reversed(forest)]
+        open_ids: List[int] = []   # ancestors of the current node, to close their ranges
+        while nodeStack:
+            currentNode, parent = nodeStack.pop()
+            while open_ids and open_ids[-1] != parent:
+                ends[open_ids.pop()] = len(titles)
+            index = len(titles)
+            titles.append(currentNode.title)
+            notes.append(currentNode.note)
+            parents.append(parent)
+            ends.append(0)
+            open_ids.append(index)
+            for child in reversed(currentNode.children):
+                nodeStack.append((child, index))
+        for index in open_ids:
+            ends[index] = len(titles)
+        return cls(titles, notes, parents, ends)
+
+    def survives(self, i: int, args: argparse.Namespace, outline_cache: Dict[int, bool]) -> bool:
+        '''
+        Whether node i is kept by pruning (see utils.prune_nodes): it is not an ignored item,
+        and neither it nor an ancestor is an ignored outline (ignored items pass their children on).
+        '''
+        node = Node(self.titles[i])
+        if is_ignored_item(node, args) or is_ignored_outline(node, args):
+            return False
+        chain = []
+        parent = self.parents[i]
+        while parent >= 0 and parent not in outline_cache:
+            chain.append(parent)
+            parent = self.parents[parent]
+        dropped = outline_cache.get(parent, False)
+        for ancestor in reversed(chain):
+            if not dropped:
+                node = Node(self.titles[ancestor])
+                dropped = is_ignored_outline(node, args) and not is_ignored_item(node, args)
+            outline_cache[ancestor] = dropped
+        return not dropped
+
+    def find_start(self, prefix: str, args: argparse.Namespace) -> Optional[int]:
+        '''The node preprocess_forest would select for --start prefix: the first surviving match.'''
+        lo = bisect_left(self.sorted_titles, prefix)
+        candidates = []
+        for i in range(lo, len(self.sorted_titles)):
+            if not self.sorted_titles[i].startswith(prefix):
+                break
+            candidates.append(self.sorted_ids[i])
+        outline_cache: Dict[int, bool] = {}
+        for candidate in sorted(candidates):
+            if self.survives(candidate, args, outline_cache):
+                return candidate
+        return None
+
+    def build(self, ids: List[int]) -> List[Node]:
+        '''Node trees for the nodes ids (in document order, closed under parents), as parsed.'''
+        nodes: Dict[int, Node] = {}
+        roots: List[Node] = []
+        for i in ids:
+            node = Node(self.titles[i])
+            node.note = self.notes[i]
+            parent = nodes.get(self.parents[i])
+            if parent is None:
+                roots.append(node)
+            else:
+                parent.children.append(node)
+                node.parent = parent
+            nodes[i] = node
+        return roots
+
+    def subtree(self, i: int) -> Node:
+        return self.build(range(i, self.ends[i]))[0]
+
+    def filter_forest(self, substring: str) -> List[Node]:
+        '''
+        The part of the forest utils.filter needs for substring: the nodes whose title contains it
+        with their subtrees and their ancestors.  Pruning and filtering are left to the usual code.
+        '''
+        keep = bytearray(len(self.titles))
+        for i, title in enumerate(self.titles):
+            # ancestors come first, so a kept node is inside a subtree already kept
+            if keep[i] or substring not in title:
+                continue
+            keep[i:self.ends[i]] = b'\1' * (self.ends[i] - i)
+            parent = self.parents[i]
+            while parent >= 0 and not keep[parent]:
+                keep[parent] = 1
+                parent = self.parents[parent]
+        return self.build([i for i, kept in enumerate(keep) if kept])
+
+
+def index_path(input_path: str) -> str:
+    key = hashlib.sha256(os.path.abspath(input_path).encode('utf-8')).hexdigest()
+    return cache_dir('index', key[:2], key)
+
+
+def index_key(input_path: str, args: argparse.Namespace) -> tuple:
+    '''What the index of input_path depends on: the file itself and how it is parsed.'''
+    st = os.stat(input_path)
+    return (INDEX_VERSION, os.path.abspath(input_path), st.st_mtime_ns, st.st_size, args.input_format)
+
+
+def load_index(input_path: str, args: argparse.Namespace) -> Optional[OutlineIndex]:
+    '''The index saved for input_path, None if there is none or if the input changed since.'''
+    try:
+        with open(index_path(input_path), 'rb') as f:
+            key = pickle.load(f)
+            if key != index_key(input_path, args):
+                return None
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return None
+
+
+def save_index(input_path: str, forest: List[Node], args: argparse.Namespace):
+    index = OutlineIndex.from_forest(forest)
+    data = pickle.dumps(index_key(input_path, args), pickle.HIGHEST_PROTOCOL) + \
+        pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+    write_atomic(index_path(input_path), data)
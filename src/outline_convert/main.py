@@ -1,40 +1,46 @@
 import argparse
+import io
 import os
 import sys
 import xml.etree.ElementTree as ET
-import zipfile
 from contextlib import nullcontext
-from doctest import debug
-from typing import Optional, List
-
-import pyperclip
-
-from openai import OpenAI
+from typing import Iterable, Iterator, Optional, List, Set, Tuple
 
+# openai, pyperclip, zipfile, the AI prompt machinery and all renderers but the text one are
+# imported where they are used: the CLI is often run in loops, and a plain text conversion
+# should not pay for them at startup
 
 from .models import Node
-from .parser import parse_text, parse_opml
-from .renderer_latex import render_latex_beamer, render_latex
-from .renderer_text import render_text, render_opml
+from .parser import parse_text, iter_text_chunks, build_text_tree, parse_opml_stream, detect_format
+from .renderer_text import iter_opml, iter_text, iter_text_tree
 #from .utils import find_node, print_tree, ignore_forest, print_forest, filter, handle_ai_prompt, handle_ai_prompts
 # issue 65 (enhancement): preprocess_forest sets node style to normal when required
-from .utils import find_node, print_tree, ignore_forest, print_forest, filter, preprocess_forest
-from .renderer_ppt import render_ppt
-from .renderer_rtf import render_rtf
+# it also prunes ignored items and selects the start item, in the same walk
+from .utils import print_tree, print_forest, filter_forests, preprocess_forest
 
 # -- MAIN PROGRAM -----------------------------------------------------
 
 
-def send_prompt(message, args:argparse.Namespace) -> str:
-    # Initialize the client (make sure you set your OPENAI_API_KEY in environment variables)
+def make_ai_client():
+    from openai import OpenAI
 
+    # Initialize the client (make sure you set your OPENAI_API_KEY in environment variables)
     apiKey = os.getenv("OPENAI_API_KEY")
-    client = OpenAI(api_key=apiKey)
+    return OpenAI(api_key=apiKey)
+
+
+# model="gpt-5",  # or "gpt-4o-mini" if you prefer a lighter model
+AI_MODEL = "gpt-4o-mini"
 
-    # model="gpt-5",  # or "gpt-4o-mini" if you prefer a lighter model
-    aiModel = "gpt-4o-mini"
-    #if "AI" in args.debug:
-    print("using ", aiModel)
+
+def send_prompt(message, args:argparse.Namespace, client=None) -> str:
+    if client is None:
+        client = make_ai_client()
+
+    aiModel = AI_MODEL
+    # on stderr: streamed output is written while the prompts are sent, this would land in it
+    if args.debug:
+        print("using ", aiModel, file=sys.stderr)
         
     # Send a prompt to the GPT model
     response = client.chat.completions.create(
@@ -52,72 +58,354 @@ def send_prompt(message, args:argparse.Namespace) -> str:
     return(response.choices[0].message.content)
 
 
-def handle_ai_prompts(forest: List[Node], args: argparse.Namespace): 
-    retval = []
-    for oneTree in forest:
-        retval.append(handle_ai_prompt(oneTree, args))
-    return(retval)
-    
-    
-def handle_ai_prompt(node: Node, args: argparse.Namespace):
-    if "#ai-prompt" in node.title:
-        theForest = handle_ai_prompts(node.children, args)
-        thePrompt = render_text(theForest, args) # TODO make args optional
-        promptTxt = "\n".join(thePrompt)
-        # print("thePrompt=", promptTxt)
-        returnNode = Node(send_prompt(node.title + promptTxt, args))
-        # restore style
-        returnNode.set_style(node.style)
-        returnNode.children = []
+def collect_ai_prompts(forest: List[Node]) -> List[Tuple[Node, Optional[Node]]]:
+    """
+    Every #ai-prompt node, in document order, with the nearest #ai-prompt node enclosing it (or None).
+    The trees may share subtrees (see convert_queries): a shared prompt comes once per enclosing prompt.
+    """
+    prompts = []
+    seen = set()
+    nodeStack = [(tree, None) for tree in reversed(forest)]
+    while nodeStack:
+        currentNode, enclosing = nodeStack.pop()
+        # the substring test first, so that titles without it are not split into tags
+        if "#ai-prompt" in currentNode.title and "#ai-prompt" in currentNode.tags:
+            if (currentNode, enclosing) in seen:
+                continue
+            seen.add((currentNode, enclosing))
+            prompts.append((currentNode, enclosing))
+            enclosing = currentNode
+        for child in reversed(currentNode.children):
+            nodeStack.append((child, enclosing))
+    return prompts
+
+
+# set once the run met an #ai-prompt item, only then may the answer cache need trimming; worker
+# processes hand it back with their results (see convert_text_chunk and batch_convert)
+AI_PROMPTS_SEEN = False
+
+
+def handle_ai_prompts(forest: List[Node], args: argparse.Namespace) -> List[Node]:
+    """
+    Replace every #ai-prompt item, in place, by the answer to its title followed by its subtree
+    rendered as text.  A prompt is sent once all the prompts nested in it are answered; prompts
+    that do not depend on each other are sent concurrently, at most args.ai_concurrency at a time,
+    through a single client.
+    Answers are deterministic (see send_prompt), so they are kept in an on-disk cache keyed on the
+    model and the prompt text, unless --no-ai-cache is given; the client is only created on a miss.
+    The cache is trimmed by evict_ai_cache, once per run rather than per call.
+    """
+    global AI_PROMPTS_SEEN
+    prompts = collect_ai_prompts(forest)
+    if not prompts:
+        return forest
+    AI_PROMPTS_SEEN = True
+
+    from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+    from .cache import ResponseCache, cache_dir
+
+    enclosing_prompts = {node: [] for node, _ in prompts}
+    unanswered = dict.fromkeys(enclosing_prompts, 0)   # nested prompts still to be answered
+    for node, enclosing in prompts:
+        if enclosing is not None:
+            enclosing_prompts[node].append(enclosing)
+            unanswered[enclosing] += 1
+
+    cache = None if args.no_ai_cache else ResponseCache(cache_dir("ai"), debug=args.debug)
+    client = None
+    sent = {}   # prompt text of the futures that went to the model
+
+    with ThreadPoolExecutor(max_workers=args.ai_concurrency) as executor:
+        def ask(node: Node) -> Future:
+            nonlocal client
+            # tree by tree: a prompt's subtree is never worth a process pool
+            promptTxt = "\n".join(line for child in node.children for line in iter_text_tree(child, args)) # TODO make args optional
+            message = node.title + promptTxt
+            if cache is not None:
+                answer = cache.get(AI_MODEL, message)
+                if answer is not None:
+                    if args.debug:
+                        print("cached answer for", node.title, file=sys.stderr)
+                    future = Future()
+                    future.set_result(answer)
+                    return future
+            if client is None:
+                client = make_ai_client()
+            future = executor.submit(send_prompt, message, args, client)
+            sent[future] = message
+            return future
+
+        running = {ask(node): node for node, count in unanswered.items() if count == 0}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                if cache is not None and future in sent:
+                    cache.put(AI_MODEL, sent.pop(future), future.result())
+                # the answer replaces the prompt and its subtree, the style is kept
+                node.set_title(future.result())
+                node.children = []
+                node.note = None
+
+                for enclosing in enclosing_prompts[node]:
+                    unanswered[enclosing] -= 1
+                    if unanswered[enclosing] == 0:
+                        running[ask(enclosing)] = enclosing
+
+    return forest
+
+
+def evict_ai_cache(args: argparse.Namespace):
+    """Trim the AI answer cache once per run, after the conversion, if the run added answers to it."""
+    if args.no_ai_cache or not AI_PROMPTS_SEEN:
+        return
+    from .cache import ResponseCache, cache_dir
+    ResponseCache(cache_dir("ai"), debug=args.debug).evict_written()
+
+
+
+
+def read_lines(stream) -> Iterator[str]:
+    """Lazily yield the lines of a text or binary stream, like str.splitlines()."""
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8')
+    for line in stream:
+        yield from line.splitlines()
+
+
+def write_lines(lines: Iterable[str], f):
+    """Write lines to f separated by new lines, like '\\n'.join(lines) without building the string."""
+    sep = ''
+    for line in lines:
+        f.write(sep + line)
+        sep = '\n'
+
+
+def can_stream_text(args: argparse.Namespace) -> bool:
+    """Text to text conversions that do not need the whole forest at once."""
+    return args.format == 'txt' and not (args.start or args.filter or args.query or args.clipboard
+                                         or getattr(args, 'queries', None))
+
+
+def convert_text_chunk(chunk: Tuple[List[Tuple[str, str, str]], int],
+                       args: argparse.Namespace) -> Tuple[List[str], bool]:
+    """
+    Streamed conversion of one top-level tree: build, prune and preprocess, answer its prompts, render.
+    Returns the lines and AI_PROMPTS_SEEN.
+    """
+    forest = preprocess_forest([build_text_tree(*chunk)], args)
+    return list(iter_text(handle_ai_prompts(forest, args), args)), AI_PROMPTS_SEEN
+
+
+def stream_text(chunks: Iterable[Tuple[List[Tuple[str, str, str]], int]], args: argparse.Namespace):
+    """
+    Streaming text to text conversion: every tree is built, pruned, preprocessed,
+    rendered and written before the next one is parsed, so memory is bounded
+    by the largest tree of the input rather than by the whole outline.
+    With --jobs N, N trees are converted at the same time in worker processes
+    and written in their original order.
+    """
+    from .parallel import ordered_map
+
+    if args.output:
+        os.makedirs(args.dir, exist_ok=True)
+        path = os.path.join(args.dir, args.output)
+        sink = open(path, 'w', encoding='utf-8')
     else:
-        # return the tree with the same root but children handled recursively
-        returnNode = Node(node.title)
-        # restore style
-        returnNode.set_style(node.style)
-        returnNode.children = handle_ai_prompts(node.children, args)
-        
-    return(returnNode)
+        print("Output to stdout")
+        sink = nullcontext(sys.stdout)
 
+    def text_lines():
+        global AI_PROMPTS_SEEN
+        for lines, prompts_seen in ordered_map(convert_text_chunk, chunks, args.jobs, args):
+            AI_PROMPTS_SEEN = AI_PROMPTS_SEEN or prompts_seen
+            yield from lines
 
+    with sink as f:
+        write_lines(text_lines(), f)
+        if not args.output:
+            f.write('\n')
 
+    if args.output and args.debug:
+        print(f"Wrote {path}")
 
-def main():
-    # -- Argument parser configuration -------------------------------
-    p = argparse.ArgumentParser(description='Convert between text outline, OPML, and LaTeX')
 
-    # Input/Output arguments
-    p.add_argument('input', nargs='?', help='Input file (omit for stdin or use --date)')
-    p.add_argument('-c', '--clipboard', action='store_true', help='Read from clipboard')
-    p.add_argument('-o', '--output', help='Output filename (omit for auto)')
+class InputFormatError(ValueError):
+    """The input is not in the format given by --input-format."""
+
+
+def parse_input(stream, args: argparse.Namespace, name: Optional[str] = None) -> Optional[List[Node]]:
+    """
+    Send a seekable stream to the parser for its format (see --input-format).
+    Text input that can be streamed (see can_stream_text) is converted and
+    written right away, None is returned in that case.
+    Raises InputFormatError when the input is not in the format --input-format asks for.
+    """
+    input_format = args.input_format
+    if input_format == 'auto':
+        input_format = detect_format(stream, name)
+        if args.debug:
+            print(f"detected input format: {input_format}")
+
+    if input_format == 'opml':
+        try:
+            forest = parse_opml_stream(stream, args=args)
+            print("ompl parsed correctly")
+            return forest
+        except ET.ParseError as e:
+            if args.input_format == 'opml':
+                raise InputFormatError(f"input is not valid OPML: {e}")
+            if args.debug:
+                print("ompl not parsed correctly")
+            stream.seek(0)
+
+    if can_stream_text(args):
+        stream_text(iter_text_chunks(read_lines(stream)), args)
+        return None
+    return parse_text(read_lines(stream), args)
+
+
+def indexed_forest(args: argparse.Namespace) -> Optional[List[Node]]:
+    '''
+    The part of args.input that --start or --filter needs, from the index saved by an earlier
+    --index run instead of parsing the input; None if there is no up to date index.
+    '''
+    from .index import load_index
+
+    index = load_index(args.input, args)
+    if index is None:
+        return None
+    if args.debug:
+        print(f"Using the index of {args.input}")
+    if args.start:
+        start = index.find_start(args.start, args)
+        return [] if start is None else [index.subtree(start)]
+    return index.filter_forest(args.filter)
+
+
+def newest_file(directory: str, pattern: Optional[str] = None, recursive: bool = False) -> Optional[str]:
+    '''
+    The most recently modified file in directory (and its subdirectories if recursive) whose
+    name matches the glob pattern, if any.  Entries come from scandir, so only the files that
+    match are stat'ed, once each; symbolic links to directories are not followed.
+    '''
+    match = None
+    if pattern:
+        import fnmatch
+        import re
+        # fnmatch.fnmatch, compiled once
+        match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+
+    chosen = None
+    latest_time = float('-inf')
+    dirs = [directory]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            dirs.append(entry.path)
+                        continue
+                    if match is not None and not match(os.path.normcase(entry.name)):
+                        continue
+                    if not entry.is_file():
+                        continue
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if mtime > latest_time:
+                    latest_time = mtime
+                    chosen = entry.path
+    return chosen
+
+
+def choose_zip_backup(zip_dir: str, member: str, args: argparse.Namespace) -> Optional[str]:
+    '''
+    The most recent zip backup in zip_dir (a file with 'opml' in its name) that holds member.
+    A single scandir pass orders the candidates by mtime, then they are tried newest first:
+    the member lists come from the ZipIndex in the cache directory, so an archive is only
+    opened the first time it is seen; normally that is just the newest one.  An index that
+    cannot be read or saved is no index.
+    '''
+    from .cache import ZipIndex, cache_dir
+
+    candidates = []
+    with os.scandir(zip_dir) as entries:
+        for entry in entries:
+            if 'opml' in entry.name and entry.is_file():
+                st = entry.stat()
+                candidates.append((st.st_mtime, entry.path, entry.name, st))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    index = ZipIndex(cache_dir('zip-index.json'))
+    chosen = None
+    for _, path, _, st in candidates:
+        members = index.members(path, st)
+        if members is not None and member in members:
+            chosen = path
+            break
+        if args.debug:
+            reason = "not a zip file" if members is None else f"no '{member}' in it"
+            print(f"Skipping {os.path.basename(path)}: {reason}", file=sys.stderr)
+    try:
+        index.save(zip_dir, {name for _, _, name, _ in candidates})
+    except OSError as e:
+        # the index only saves time, -z works without it
+        if args.debug:
+            print(f"Cannot save the zip index {index.path}: {e}", file=sys.stderr)
+    return chosen
+
+
+def positive_int(value: str) -> int:
+    '''argparse type of the options that count something that must be there at least once.'''
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def add_conversion_arguments(p: argparse.ArgumentParser):
+    '''Options shared by single file conversions and batch mode.'''
     p.add_argument('-d', '--dir', default='.', help='Output directory')
 
     # Metadata arguments
     p.add_argument('-e', '--email', help='Author email')
     p.add_argument('-a', '--author', help='Author name')
     p.add_argument('-g', '--graphicspath', help='Path to graphics')
-    p.add_argument('-f', '--format', choices=['txt', 'opml', 'latex', 'beamer', 'ppt', 'rtf', 'docx'], default='txt',
-                   help='Output format: plain text, OPML, LaTeX Article, LaTeX Beamer, PowerPoint, Rich Text')
+    p.add_argument('--input-format', choices=['auto', 'txt', 'opml'], default='auto',
+                   help='Input format, auto detects it from the file name or content')
     p.add_argument('-s', '--start', help='Start item for conversion')
-
-    p.add_argument('-m', '--date', metavar='DIR',
-                   help='Choose most recently modified file in directory DIR as input')
-    p.add_argument('-z', nargs=2, metavar=('ZIP_DIRECTORY', 'PATH_TO_FILE_FROM_ZIP_FOLDER'),
-                   help='Choose the selected file in the most recent zip backup')
     p.add_argument('--expert-mode', action='store_true',
                    help='Enter expert mode to interpret nodes tagged with specific labels, see readme')
     p.add_argument('-p', '--parse-markdown', action='store_true',
                    help='Parse markdown syntax for links and images')
     p.add_argument('--filter',
                    help='Filter a specific string and return the path to it')
+    p.add_argument('-q', '--query', metavar='EXPR',
+                   help='Filter the items matching a query expression (words, #tags, /regex/, is:completed, '
+                        'depth<N, AND, OR, NOT, parentheses), see readme')
     #p.add_argument('--biblio', nargs=1, metavar=('BIBTEX_FILE'),
     p.add_argument('--biblio',
                    help='Specify a fully qualified bibTex file name')
+    p.add_argument('--ai-concurrency', type=positive_int, default=4, metavar='N',
+                   help='Maximum number of #ai-prompt items sent at the same time')
+    p.add_argument('--no-ai-cache', action='store_true', default=False,
+                   help='Always send #ai-prompt items, ignoring and not updating the answer cache')
+    p.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                   help='Convert independent trees (or files in batch mode) in N processes')
 
 
     # Output formatting arguments
     p.add_argument('--strip-tags', action='store_true', default=False, help='Strip tags from input')
     p.add_argument('--fragment', action='store_true', default=False, help='Only keep body of document for latex beamer and opml')
-    p.add_argument('-w','--wait', action='store_true', default=False, help='Wait for key press after execution')
     p.add_argument('--debug', action='store_true', default=False, help='Gives debug information')
     p.add_argument('--test', action='store_true', default=False, help='Testing only, no output created')
     p.add_argument('--parse-only', action='store_true', default=False, help='Create parse tree only')
@@ -128,72 +416,12 @@ def main():
     p.add_argument( '--hide-completed',action='store_true', default=False, help="Hide completed items")
     p.add_argument( '--completed-only',action='store_true', default=False, help="Only includes completed items")
 
-    args = p.parse_args()
-
-    # -- Handle automatic date-based selection ----------------------
-    if args.date:
-        date_dir = args.date
-        if not os.path.isdir(date_dir):
-            sys.exit(f"Error: '{date_dir}' is not a directory.")
-        candidates = [
-            os.path.join(date_dir, name)
-            for name in os.listdir(date_dir)
-            if os.path.isfile(os.path.join(date_dir, name))
-        ]
-        if not candidates:
-            sys.exit(f"No files found in '{date_dir}'.")
-        chosen = max(candidates, key=lambda p: os.path.getmtime(p))
-        if args.debug:
-            print(f"Using latest file: {os.path.basename(chosen)}", file=sys.stderr)
-        args.input = chosen
-
-    if args.z:
-        zip_dir = args.z[0]
-        file = args.z[1]
-              
-        if not os.path.isdir(zip_dir):
-            sys.exit(f"Error: '{zip_dir}' is not a directory.")
-        chosen = None
-        latest_time = 0
-
-        for name in os.listdir(zip_dir):
-            full_path = os.path.join(zip_dir, name)
-            if zipfile.is_zipfile(full_path) and 'opml' in name:
-                mtime = os.path.getmtime(full_path)
-                if mtime > latest_time:
-                    latest_time = mtime
-                    chosen = full_path
-
-        if not chosen:
-            sys.exit(f"No correct zip files found in '{zip_dir}'.")
-        if args.debug:
-            print(f"Using latest zip file: {os.path.basename(chosen)}", file=sys.stderr)
-        with zipfile.ZipFile(chosen, 'r') as zip_ref:
-            with zip_ref.open(file) as f:
-                lines = f.read().decode('utf-8').splitlines()
-
-    # -- Read input data ------------------------------------------
-    elif args.input:
-        with open(args.input, 'r', encoding='utf-8') as file:
-            lines = file.read().splitlines()
-    elif args.clipboard:
-        lines = pyperclip.paste().splitlines()
-    else:
-        print('Paste outline below. Finish with Ctrl+D (linux) or Ctrl+Z + Enter(Windows):')
-        lines = sys.stdin.read().splitlines()
-
-    # -- Parse content --------------------------------------------
-    root_node: Node
-    try:
-        tree = ET.fromstringlist(lines)
-        forest = ignore_forest(parse_opml(tree, args=args), args)
-        print("ompl parsed correctly")
-
-    except ET.ParseError:
-        if args.debug:
-            print("ompl not parsed correctly")
-        forest = ignore_forest(parse_text(lines, args), args)
 
+def convert_forest(forest: List[Node], args: argparse.Namespace) -> List[Node]:
+    '''
+    Everything between parsing and rendering: pruning and preprocessing, --start,
+    --filter and the #ai-prompt items.  The result does not depend on the output format.
+    '''
     '''
     MJI:
     issue 65 (enhancement)
@@ -217,82 +445,404 @@ def main():
     so the trees only have to be walked once.
     See preprocess_forest(), which I'm putting in utils.py
     (I know, I'm filling utils with even more stuff, but why not -- everything else is in there...)
+    Done: preprocess_forest() now prunes, sets styles and selects the --start item
+    (the optional subtree extraction) in a single walk, see PREPROCESS_VISITORS;
+    ignore_forest() and ignore_tree() are gone.
     '''
-    forest = preprocess_forest(forest, args)
+    forest = select_forest(forest, args)
+
+    matcher = filter_matcher(args)
+    if matcher is not None:
+        forest = filter_forests(forest, [matcher])[0]
+        if not forest:
+            if args.query:
+                forest = [Node(f"Query '{args.query}' matched nothing")]
+            else:
+                forest = [Node(f"Filter prefix '{args.filter}' not found")]
+    # filter function can return filter not found if the start prefix was not found
     
 
+    # deal with any AI prompt tags
+    return handle_ai_prompts(forest, args)
 
 
-    # -- Optional subtree extraction ------------------------------
+def select_forest(forest: List[Node], args: argparse.Namespace) -> List[Node]:
+    '''Pruning and preprocessing, and the --start item.'''
+    forest = preprocess_forest(forest, args)
 
     if args.start:
-        f = find_node(forest, args.start)
-        forest = f
         if not forest:
             forest = [Node(f"Start prefix '{args.start}' not found")]
         elif args.debug:
             print(f"Start prefix '{args.start}' found")
             
         #print_forest(forest)
-    if args.filter:
-        forest = filter(forest, args.filter)
-        if not forest:
-            forest = [Node(f"Filter prefix '{args.filter}' not found")]
-    # filter function can return filter not found if the start prefix was not found
-    
+    return forest
 
-    # deal with any AI prompt tags
-    forest = handle_ai_prompts(forest, args)
-
-    
 
+def filter_matcher(args: argparse.Namespace):
+    '''The matcher of --filter and --query (both must match, see query.py), None without them.'''
+    matchers = []
+    if args.filter:
+        substring = args.filter
+        matchers.append(lambda node, depth: substring in node.title)
+    if args.query:
+        from .query import compile_query
+        matchers.append(compile_query(args.query))
+    if len(matchers) == 2:
+        first, second = matchers
+        return lambda node, depth: first(node, depth) and second(node, depth)
+    return matchers[0] if matchers else None
+
+
+def convert_queries(forest: List[Node], queries: List[Tuple[str, str]],
+                    args: argparse.Namespace) -> Iterator[Tuple[str, List[Node]]]:
+    '''
+    convert_forest for every named query of --queries: the forest is preprocessed once and
+    filtered for all the queries in a single walk (see utils.filter_forests), then the
+    #ai-prompt items of all the results are answered together, those of the subtrees the
+    results share only once.  Yields (name, converted forest) pairs.
+    '''
+    from .query import compile_query
+
+    forest = select_forest(forest, args)
+    matchers = [compile_query(expression) for _, expression in queries]
+    common = filter_matcher(args)
+    if common is not None:
+        matchers = [lambda node, depth, matcher=matcher: common(node, depth) and matcher(node, depth)
+                    for matcher in matchers]
+    results = filter_forests(forest, matchers)
+    for (_, expression), result in zip(queries, results):
+        if not result:
+            result.append(Node(f"Query '{expression}' matched nothing"))
+    handle_ai_prompts([tree for result in results for tree in result], args)
+    for (name, _), result in zip(queries, results):
+        yield name, result
+
+
+def check_queries(p: argparse.ArgumentParser, args: argparse.Namespace):
+    '''
+    Compile --query and read and compile --queries (into args.queries, as (name, expression)
+    pairs) before any input is read, so that mistakes are reported right away.
+    '''
+    if not (args.query or getattr(args, 'queries', None)):
+        return
+    from .query import compile_query, read_queries
 
-    # -- Render based on chosen format ---------------------------
-    out_lines: Optional[List[str]] = None
-    out_tree: Optional[ET.ElementTree] = None
+    try:
+        if args.query:
+            compile_query(args.query)
+        if getattr(args, 'queries', None):
+            if args.output or args.clipboard:
+                p.error("--queries writes one file per query to --dir, it does not go with -o or -c")
+            args.queries = read_queries(args.queries)
+            for _, expression in args.queries:
+                compile_query(expression)
+    except OSError as e:
+        p.error(f"cannot read the queries: {e}")
+    except ValueError as e:
+        p.error(f"invalid query: {e}")
+
+
+def render_forest(forest: List[Node], args: argparse.Namespace) -> Optional[Iterable[str]]:
+    '''
+    Render the forest in args.format: the lines of the output, produced lazily while
+    they are written to the output.
+    '''
+    out_lines: Optional[Iterable[str]] = None
     if args.format == 'txt':
         tab=args.indent_string
         if tab == "\\t":
             tab = '\t'
-        out_lines = render_text(forest, args)
+        out_lines = iter_text(forest, args)
     elif args.format == 'latex':
-        out_lines = render_latex(forest, args)
+        from .renderer_latex import iter_latex
+        out_lines = iter_latex(forest, args)
     elif args.format == 'beamer':
-        out_lines = render_latex_beamer(forest, args)
+        from .renderer_latex import iter_latex_beamer
+        out_lines = iter_latex_beamer(forest, args)
     elif args.format == 'opml':  # opml
-        out_tree = render_opml(forest, args)
+        out_lines = iter_opml(forest, args)
     elif args.format == 'ppt':
+        from .renderer_ppt import render_ppt
         out_lines = render_ppt(forest, args)
     elif args.format == 'rtf':
+        from .renderer_rtf import render_rtf
         out_lines = render_rtf(forest, args)
+    return out_lines
 
-    # -- Handle output -------------------------------------------
+
+def write_output(out_lines: Optional[Iterable[str]], args: argparse.Namespace):
+    '''Send the rendered output to the clipboard, stdout or args.dir/args.output.'''
+    if out_lines is None:
+        sys.exit(f"Error: {args.format} output is not implemented")
     if args.clipboard:
-        if out_lines is not None:
-            pyperclip.copy('\n'.join(out_lines))
-        else:
-            xml_string = ET.tostring(out_tree, encoding='unicode')
-            pyperclip.copy(xml_string)
+        import pyperclip
+        pyperclip.copy('\n'.join(out_lines))
         print("Copied to clipboard")
 
     elif not args.output:  # Output to stdout
         print("Output to stdout")
         #print(out_lines) so that we don't get confusing output
-        if out_lines is not None:
-            sys.stdout.write('\n'.join(out_lines) + '\n')
-        else:
-            out_tree.write(sys.stdout.buffer, encoding='utf-8', xml_declaration=True)
+        write_lines(out_lines, sys.stdout)
+        sys.stdout.write('\n')
     else:  # Output to file
         os.makedirs(args.dir, exist_ok=True)
         path = os.path.join(args.dir, args.output)
-        if out_lines is not None:
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(out_lines))
-        else:
-            out_tree.write(path, encoding='utf-8', xml_declaration=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            write_lines(out_lines, f)
         if args.debug:
             print(f"Wrote {path}")
 
+
+
+# -- BATCH MODE -------------------------------------------------------
+
+BATCH_FORMATS = ['txt', 'opml', 'latex', 'beamer']
+# beamer gets its own suffix so that it does not overwrite the latex article
+BATCH_SUFFIXES = {'txt': '.txt', 'opml': '.opml', 'latex': '.tex', 'beamer': '_beamer.tex'}
+
+
+def batch_inputs(patterns: List[str], manifest: Optional[str] = None) -> List[str]:
+    '''
+    Expand the batch inputs into a list of files, in order and without duplicates.
+    Every input is a directory (its files, not recursively), a glob pattern or a file.
+    A manifest lists more inputs, one per line, relative to the manifest's directory;
+    blank lines and lines starting with # are skipped.
+    '''
+    import glob
+
+    patterns = list(patterns)
+    if manifest:
+        base = os.path.dirname(manifest)
+        with open(manifest, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(os.path.join(base, os.path.expanduser(line)))
+
+    files: List[str] = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.extend(sorted(entry.path for entry in os.scandir(pattern) if entry.is_file()))
+        elif glob.has_magic(pattern):
+            files.extend(path for path in sorted(glob.glob(pattern)) if os.path.isfile(path))
+        else:
+            files.append(pattern)
+    return list(dict.fromkeys(files))
+
+
+def batch_convert(job: Tuple[str, str], args: argparse.Namespace, protected: Set[str]) -> Tuple[int, str, str, bool]:
+    '''
+    Convert the file job = (path, output name) in every format of args.formats.
+    Returns the exit status and what was printed on stdout and stderr, so that the messages of
+    files converted in parallel come out in order, and AI_PROMPTS_SEEN.
+    '''
+    from contextlib import redirect_stderr, redirect_stdout
+
+    path, name = job
+    out, err = io.StringIO(), io.StringIO()
+    status = 0
+    with redirect_stdout(out), redirect_stderr(err):
+        args.input = path
+        args.format = None   # not known yet: keeps parse_input from streaming the text
+        try:
+            with open(path, 'rb') as file:
+                forest = parse_input(file, args, name=path)
+        except OSError as e:
+            print(f"Error: cannot read '{path}': {e}", file=sys.stderr)
+            return 1, out.getvalue(), err.getvalue(), AI_PROMPTS_SEEN
+        except (ValueError, ET.ParseError) as e:
+            # UnicodeDecodeError and InputFormatError are ValueErrors
+            print(f"Error: cannot convert '{path}': {e}", file=sys.stderr)
+            return 1, out.getvalue(), err.getvalue(), AI_PROMPTS_SEEN
+        forest = convert_forest(forest, args)
+
+        for fmt in args.formats:
+            args.format = fmt
+            args.output = name + BATCH_SUFFIXES[fmt]
+            out_path = os.path.join(args.dir, args.output)
+            if os.path.realpath(out_path) in protected:
+                print(f"Error: not overwriting input '{out_path}'", file=sys.stderr)
+                status = 1
+                continue
+            write_output(render_forest(forest, args), args)
+    return status, out.getvalue(), err.getvalue(), AI_PROMPTS_SEEN
+
+
+def batch_main(argv: List[str]) -> int:
+    '''
+    outline-convert batch: parse and preprocess every input once, then render it in every
+    requested format.  Outputs are written to --dir, named after the input file.
+    Returns the exit status: 1 if any input could not be converted.
+    '''
+    p = argparse.ArgumentParser(prog='outline-convert batch',
+                                description='Convert many outlines to several formats in one run')
+    p.add_argument('inputs', nargs='*', help='Input files, directories or glob patterns')
+    p.add_argument('--manifest', help='File listing more inputs, one per line')
+    p.add_argument('-F', '--formats', nargs='+', choices=BATCH_FORMATS, default=BATCH_FORMATS,
+                   help='Output formats (default: all of them)')
+    add_conversion_arguments(p)
+    args = p.parse_args(argv)
+    if not args.inputs and not args.manifest:
+        p.error('no inputs given')
+    check_queries(p, args)
+    # single file options that batch mode does not offer
+    args.clipboard = False
+    args.wait = False
+    args.date = None
+    args.z = None
+
+    from .utils import sanitize_filename
+    from .parallel import ordered_map
+
+    inputs = batch_inputs(args.inputs, args.manifest)
+    jobs = []
+    used = set()
+    for path in inputs:
+        stem = sanitize_filename(os.path.splitext(os.path.basename(path))[0])
+        name, n = stem, 1
+        while name in used:
+            n += 1
+            name = f"{stem}_{n}"
+        used.add(name)
+        jobs.append((path, name))
+    # outputs may land next to the inputs, none of them is overwritten
+    protected = {os.path.realpath(path) for path in inputs}
+
+    # with --jobs, files are converted in parallel rather than the trees of each file
+    file_jobs = args.jobs if len(jobs) > 1 else 1
+    if file_jobs > 1:
+        args.jobs = 1
+    status = 0
+    global AI_PROMPTS_SEEN
+    for file_status, out, err, prompts_seen in ordered_map(batch_convert, jobs, file_jobs, args, protected):
+        AI_PROMPTS_SEEN = AI_PROMPTS_SEEN or prompts_seen
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        status = max(status, file_status)
+    evict_ai_cache(args)
+    return status
+
+
+def read_input(args: argparse.Namespace) -> Optional[List[Node]]:
+    """
+    The forest of the input chosen by -z, the input file (or its index), -c or stdin, see
+    parse_input; None when the text input was already converted by stream_text.
+    """
+    if args.z:
+        import zipfile
+        zip_dir = args.z[0]
+        file = args.z[1]
+
+        if not os.path.isdir(zip_dir):
+            sys.exit(f"Error: '{zip_dir}' is not a directory.")
+        chosen = choose_zip_backup(zip_dir, file, args)
+        if not chosen:
+            sys.exit(f"No correct zip files with '{file}' found in '{zip_dir}'.")
+        if args.debug:
+            print(f"Using latest zip file: {os.path.basename(chosen)}", file=sys.stderr)
+        # the member is decompressed while it is parsed, it is never read in one go
+        with zipfile.ZipFile(chosen, 'r') as zip_ref:
+            with zip_ref.open(file) as f:
+                forest = parse_input(f, args, name=file)
+    elif args.input:
+        forest = None
+        if args.index and (args.start or args.filter):
+            forest = indexed_forest(args)
+        if forest is None:
+            with open(args.input, 'rb') as file:
+                forest = parse_input(file, args, name=args.input)
+            if args.index and forest is not None:
+                from .index import save_index
+                save_index(args.input, forest, args)
+    elif args.clipboard:
+        import pyperclip
+        forest = parse_input(io.StringIO(pyperclip.paste()), args)
+    else:
+        print('Paste outline below. Finish with Ctrl+D (linux) or Ctrl+Z + Enter(Windows):')
+        if args.input_format == 'txt':
+            # nothing to detect, so stdin does not need to be seekable
+            forest = parse_input(sys.stdin, args)
+        else:
+            forest = parse_input(io.StringIO(sys.stdin.read()), args)
+    return forest
+
+
+def main():
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        from .server import serve_main
+        sys.exit(serve_main(sys.argv[2:]))
+
+    # -- Argument parser configuration -------------------------------
+    p = argparse.ArgumentParser(description='Convert between text outline, OPML, and LaTeX',
+                                epilog='Run "outline-convert batch -h" to convert many files at once, '
+                                       'or "outline-convert serve -h" to keep a conversion server running')
+
+    # Input/Output arguments
+    p.add_argument('input', nargs='?', help='Input file (omit for stdin or use --date)')
+    p.add_argument('-c', '--clipboard', action='store_true', help='Read from clipboard')
+    p.add_argument('-o', '--output', help='Output filename (omit for auto)')
+    p.add_argument('-f', '--format', choices=['txt', 'opml', 'latex', 'beamer', 'ppt', 'rtf', 'docx'], default='txt',
+                   help='Output format: plain text, OPML, LaTeX Article, LaTeX Beamer, PowerPoint, Rich Text')
+    p.add_argument('-m', '--date', metavar='DIR',
+                   help='Choose most recently modified file in directory DIR as input')
+    p.add_argument('--date-pattern', metavar='GLOB',
+                   help="With --date, only consider files matching GLOB, e.g. '*.opml'")
+    p.add_argument('--date-recursive', action='store_true', default=False,
+                   help='With --date, also look in the subdirectories of DIR')
+    p.add_argument('-z', nargs=2, metavar=('ZIP_DIRECTORY', 'PATH_TO_FILE_FROM_ZIP_FOLDER'),
+                   help='Choose the selected file in the most recent zip backup')
+    p.add_argument('-w','--wait', action='store_true', default=False, help='Wait for key press after execution')
+    p.add_argument('--queries', metavar='FILE',
+                   help='Run every named query of FILE ("name: expression" lines) in one pass, '
+                        'writing one output per query to --dir, named after the query')
+    p.add_argument('--index', action='store_true', default=False,
+                   help='Keep an index of the input file in the cache directory, so that later --start '
+                        'and --filter runs on the unchanged file do not parse it again')
+    add_conversion_arguments(p)
+
+    args = p.parse_args()
+    check_queries(p, args)
+
+    # -- Handle automatic date-based selection ----------------------
+    if args.date:
+        date_dir = args.date
+        if not os.path.isdir(date_dir):
+            sys.exit(f"Error: '{date_dir}' is not a directory.")
+        chosen = newest_file(date_dir, args.date_pattern, args.date_recursive)
+        if not chosen:
+            what = f"files matching '{args.date_pattern}'" if args.date_pattern else "files"
+            sys.exit(f"No {what} found in '{date_dir}'.")
+        if args.debug:
+            print(f"Using latest file: {os.path.basename(chosen)}", file=sys.stderr)
+        args.input = chosen
+
+    # -- Read input data ------------------------------------------
+    try:
+        forest = read_input(args)
+    except InputFormatError as e:
+        sys.exit(f"Error: {e}")
+
+    if forest is None:
+        # text input was already converted and written by stream_text
+        evict_ai_cache(args)
+        if args.wait:
+            input("Press any Enter to exit\n")
+        return
+
+    if args.queries:
+        suffix = BATCH_SUFFIXES.get(args.format, '.' + args.format)
+        for name, result in convert_queries(forest, args.queries, args):
+            args.output = name + suffix
+            write_output(render_forest(result, args), args)
+    else:
+        forest = convert_forest(forest, args)
+        write_output(render_forest(forest, args), args)
+    evict_ai_cache(args)
+
     # -- Handle final wait --------------------------------------
     if args.wait:
         input("Press any Enter to exit\n")
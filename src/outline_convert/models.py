@@ -1,8 +1,45 @@
-from typing import List, Optional
+import string
+import sys
+from typing import Dict, FrozenSet, List, Optional, Tuple
 from dataclasses import dataclass
 
+NO_TAGS: FrozenSet[str] = frozenset()
+# interned tag sets: nodes with the same tags share one set (and the tag strings)
+TAG_SETS: Dict[Tuple[str, ...], FrozenSet[str]] = {}
+TAG_SETS_MAX = 100000
+# around a tag, as in "(#hh)", "#ignore-item," or "**#slide**"
+TAG_PUNCTUATION = string.punctuation.replace('#', '')
+
+
+def tag_of(word: str) -> Optional[str]:
+    '''The #tag a word of a title stands for, once the punctuation around it is trimmed, or None.'''
+    if '#' not in word:
+        return None
+    tag = word.strip(TAG_PUNCTUATION)
+    return tag if tag.startswith('#') else None
+
+
+def title_tags(title: str) -> FrozenSet[str]:
+    '''
+    The #tags of a title, see tag_of; --strip-tags drops the same words.  The sets are interned,
+    so that the nodes only hold a reference to a shared set; most titles have none and get NO_TAGS.
+    '''
+    if '#' not in title:
+        return NO_TAGS
+    key = tuple([tag for tag in map(tag_of, title.split()) if tag is not None])
+    tags = TAG_SETS.get(key)
+    if tags is None:
+        tags = frozenset(map(sys.intern, key))
+        if len(TAG_SETS) < TAG_SETS_MAX:
+            TAG_SETS[key] = tags
+    return tags
+
 
 class Node:
+    # no per-instance __dict__: large exports hold millions of nodes
+    # one more slot would put nodes in the next allocation size class, parsing is then slower
+    __slots__ = ('title', 'children', 'parent', 'note', 'style', '_tags')
+
     # default style is 'itemised' for LaTeX -- issue 65 (enhancement)
     _DEFAULT_STYLE = "itemised"
 
@@ -13,9 +50,32 @@ class Node:
         self.note: Optional[str] = None
         # self.style: str = 'itemised' # default style is 'itemised' for LaTeX 
         self.style: str = Node._DEFAULT_STYLE 
+        # see tags: found in the title once, when first needed
+        self._tags: Optional[FrozenSet[str]] = None
 
     def set_title(self, newTitle = ""):
+        # the title is only changed here, so that the tags follow it
         self.title = newTitle
+        self._tags = None
+
+    @property
+    def tags(self) -> FrozenSet[str]:
+        '''The #tags of the title, see title_tags.'''
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = title_tags(self.title)
+        return tags
+
+    @property
+    def plain_title(self) -> str:
+        '''
+        The title without the words of its #tags (see tag_of), as --strip-tags shows it.  It is not kept on the node: one
+        more string per node costs more (in memory and garbage collection) than it saves.
+        '''
+        words = self.title.split()
+        if '#' not in self.title:
+            return ' '.join(words)
+        return ' '.join([word for word in words if tag_of(word) is None])
 
     def set_style(self, newStyle = ""):
         if newStyle:
@@ -23,6 +83,25 @@ class Node:
         else:
             self.style = Node._DEFAULT_STYLE
 
+    '''
+    Pickling (trees are handed to worker processes with --jobs, see parallel.py) flattens the
+    subtree below the node into lists, so deep outlines do not hit the recursion limit.
+    The node's own parent is not part of the pickle.
+    '''
+    def __reduce__(self):
+        titles, notes, styles, parents = [], [], [], []
+        nodeStack = [(self, -1)]
+        while nodeStack:
+            currentNode, parentIndex = nodeStack.pop()
+            index = len(titles)
+            titles.append(currentNode.title)
+            notes.append(currentNode.note)
+            styles.append(currentNode.style)
+            parents.append(parentIndex)
+            for child in reversed(currentNode.children):
+                nodeStack.append((child, index))
+        return (build_tree, (titles, notes, styles, parents))
+
     def hasChildren(self) -> bool:
         if (self.children):
             return True
@@ -54,6 +133,21 @@ class Node:
         return retval
 
 
+def build_tree(titles: List[str], notes: List[Optional[str]], styles: List[str], parents: List[int]) -> Node:
+    '''Rebuild the tree flattened by Node.__reduce__: nodes in pre-order, each with the index of its parent.'''
+    nodes: List[Node] = []
+    for title, note, style, parentIndex in zip(titles, notes, styles, parents):
+        node = Node(title)
+        node.note = note
+        node.style = style
+        if parentIndex >= 0:
+            parent = nodes[parentIndex]
+            parent.children.append(node)
+            node.parent = parent
+        nodes.append(node)
+    return nodes[0]
+
+
 @dataclass
 class TextSegment:
     text: str
@@ -0,0 +1,48 @@
+import argparse
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, TypeVar
+
+from .models import Node
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def ordered_map(func: Callable[..., R], items: Iterable[T], jobs: int, *extra) -> Iterator[R]:
+    '''
+    Yield func(item, *extra) for every item, in the order of items.
+    With jobs > 1 the calls run in a pool of that many processes (func, the items and extra must
+    then be picklable); at most 2 * jobs items are in flight, so items may be a lazy iterator
+    that is never held in memory as a whole.
+    '''
+    if jobs <= 1:
+        for item in items:
+            yield func(item, *extra)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item, *extra))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def render_tree_lines(tree: Node, render_tree: Callable[..., Iterable[str]], args: argparse.Namespace) -> List[str]:
+    return list(render_tree(tree, args))
+
+
+def map_trees(render_tree: Callable[..., Iterable[str]], forest: List[Node],
+              args: argparse.Namespace) -> Iterator[Iterable[str]]:
+    '''
+    The lines of render_tree(tree, args) for every tree of the forest, in order.
+    With --jobs N the trees are rendered in N processes, otherwise lazily one after the other.
+    '''
+    jobs = getattr(args, 'jobs', 1)
+    if jobs <= 1 or len(forest) < 2:
+        return (render_tree(tree, args) for tree in forest)
+    return ordered_map(render_tree_lines, forest, jobs, render_tree, args)
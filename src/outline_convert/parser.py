@@ -1,55 +1,106 @@
 import argparse
-from typing import List, Optional
+import os
+from math import gcd
+from typing import Iterator, List, Optional, Tuple
 
 from .models import Node
 import xml.etree.ElementTree as ET
-import re
-from .utils import detect_indent, compute_level, link_parent, print_tree, parse_opml_children
+from .utils import parse_opml_children
 
 IGNORE_OUTLINE_TAGS = {"#wfe-ignore-outline", "#ignore-outline"}
 IGNORE_ITEM_TAGS = {"#wfe-ignore-item", "#ignore-item", "#hh"}
 
+OPML_EXTENSIONS = {".opml", ".xml"}
+TEXT_EXTENSIONS = {".txt", ".md"}
+SNIFF_SIZE = 4096
+
+
+def detect_format(stream, name: Optional[str] = None) -> str:
+    '''
+    Guess the input format ('opml' or 'txt') without parsing the input.
+    An OPML file (or zip member) extension decides on its own; otherwise the first
+    non-blank characters of the stream are peeked at: XML starts with '<', and a file
+    with a text extension is only OPML when it starts with an XML declaration or <opml.
+    The stream must be seekable, it is rewound before returning.
+    '''
+    ext = os.path.splitext(name)[1].lower() if name else ''
+    if ext in OPML_EXTENSIONS:
+        return 'opml'
+
+    head = stream.read(SNIFF_SIZE)
+    stream.seek(0)
+    if isinstance(head, bytes):
+        head = head.decode('utf-8', errors='ignore')
+    head = head.lstrip('\ufeff \t\r\n')
+    if ext in TEXT_EXTENSIONS:
+        return 'opml' if head.startswith(('<?xml', '<opml')) else 'txt'
+    return 'opml' if head.startswith('<') else 'txt'
+
+
 def parse_text(lines, args):
-    trees = []
-    indent_size = detect_indent(lines)
+    return list(iter_text_trees(lines, args))
+
+
+def iter_text_trees(lines, args) -> Iterator[Node]:
+    '''
+    Single pass text outline parser.
+    Trees are yielded as soon as they are complete, so lines may be a lazy
+    iterator and only one tree is held in memory at a time.
+    '''
+    for chunk, indent_size in iter_text_chunks(lines):
+        yield build_text_tree(chunk, indent_size)
+
+
+def iter_text_chunks(lines) -> Iterator[Tuple[List[Tuple[str, str, str]], int]]:
+    '''
+    Tokenizer of iter_text_trees.
+    Every line is tokenized once into (leading whitespace, stripped text, line).
+    A non-bullet line at the left margin starts a new tree; the tokens of the
+    current tree are kept until then and yielded together with the gcd of
+    their space indents, the arguments of build_text_tree.
+    '''
     chunk = []
+    indent_size = 0
 
     for line in lines:
-        stripped = line.strip()
-        if not stripped:
+        text = line.strip()
+        if not text:
             continue   # drop blank lines
 
-        level = compute_level(line, indent_size)
-        # only start a new chunk if it's a non-bullet level-0 line
-        if level == 0 and not stripped.startswith('-'):
-            if chunk:
-                trees.append(parse_text_tree(chunk, args))
-            chunk = [line]
+        first = line[0]
+        if first == ' ' or first == '\t':
+            body = line.lstrip(' \t')
+            leading = line[:len(line) - len(body)]
+            if first == ' ':
+                tab = leading.find('\t')
+                indent_size = gcd(indent_size, tab if tab >= 0 else len(leading))
         else:
-            chunk.append(line)
+            leading = ''
+            # only start a new chunk if it's a non-bullet level-0 line
+            if text[0] != '-':
+                if chunk:
+                    yield chunk, indent_size or 1
+                chunk = []
+                indent_size = 0
+        chunk.append((leading, text, line))
 
     if chunk:
-        trees.append(parse_text_tree(chunk, args))
-    return trees
+        yield chunk, indent_size or 1
 
 
-def parse_text_tree(lines: List[str], args: argparse.Namespace) -> Node:
-    root = Node(lines[0].strip())
+def build_text_tree(chunk: List[Tuple[str, str, str]], indent_size: int) -> Node:
+    '''
+    Build one tree from the tokens collected by iter_text_chunks.
+    The first token is the root, quoted lines are notes of the preceding item.
+    '''
+    root = Node(chunk[0][1])
     stack = [(-1, root)]
-    indent_size = detect_indent(lines)
     last_node: Optional[Node] = None
-    skip_until_level: Optional[int] = None
-
-    for line in lines[1:]:
-        stripped = line.strip()
-
-        # 1) skip blank lines
-        if not stripped:
-            continue
 
-        # 2) if it's a quoted line, treat as a note
-        if stripped.startswith('"') and stripped.endswith('"'):
-            note_text = stripped.strip('"')
+    for leading, text, line in chunk[1:]:
+        # if it's a quoted line, treat as a note
+        if text[0] == '"' and text[-1] == '"':
+            note_text = text.strip('"')
             if last_node:
                 # attach to the most recently created node
                 last_node.note = note_text
@@ -58,26 +109,113 @@ def parse_text_tree(lines: List[str], args: argparse.Namespace) -> Node:
                 root.note = note_text
             continue
 
-        # 3) otherwise it's an outline item — compute its level
-        leading = line.expandtabs(indent_size)
-        level = compute_level(line, indent_size)
-
-        title = re.sub(r'^-+\s*', '', leading.strip())
+        # otherwise it's an outline item — compute its level
+        if '\t' in leading:
+            width = len(leading.expandtabs(indent_size))
+        else:
+            width = len(leading)
+        if '\t' in text:
+            # tabs inside the item are expanded relative to the whole line
+            text = line.expandtabs(indent_size).strip()
+        if text[0] == '-':
+            level = (width + indent_size) // indent_size
+            title = text.lstrip('-').lstrip()
+        else:
+            level = width // indent_size
+            title = text
 
-        # 5) create the node
         node = Node(title)
 
         # find its parent by popping until we reach the correct level
-        while stack and stack[-1][0] >= level:
+        while stack[-1][0] >= level:
             stack.pop()
         parent = stack[-1][1]
 
         parent.children.append(node)
+        node.parent = parent
         stack.append((level, node))
         last_node = node
-    link_parent(root)
     return root
 
+def parse_opml_stream(source, args: argparse.Namespace) -> List[Node]:
+    '''
+    Streaming counterpart of parse_opml: build the Node forest straight from
+    iterparse events instead of from a fully built ElementTree.
+    source is a file name or a file object (binary or text).
+    Every element is cleared and detached from its parent once its end event
+    has been seen, so memory is bounded by the depth of the outline rather
+    than by the size of the document.
+    Raises ET.ParseError if source is not well-formed XML.
+    '''
+    roots: List[Node] = []
+    doc_title: Optional[str] = None
+    seen_title = False
+    root: Optional[Node] = None
+    seen_body = False
+    in_body = False
+    elem_stack: List[ET.Element] = []
+    # one entry per open element inside body: the Node that receives
+    # its children, or None for elements that are not part of the outline
+    node_stack: List[Optional[Node]] = []
+
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        depth = len(elem_stack)
+        if event == 'start':
+            elem_stack.append(elem)
+            if in_body:
+                parent = node_stack[-1] if node_stack else None
+                if elem.tag != 'outline' or (node_stack and parent is None):
+                    node_stack.append(None)
+                elif not node_stack:
+                    # top level outline, directly below body
+                    note = elem.get('_note')
+                    if root is not None:
+                        root.children.append(Node(elem.get('text', 'Untitled').strip()))
+                        if note:
+                            root.note = note
+                        node_stack.append(root)
+                    else:
+                        node = Node(elem.get('text', 'Untitled').strip())
+                        if note:
+                            node.note = note
+                        roots.append(node)
+                        node_stack.append(node)
+                else:
+                    node = Node(elem.get('text', ''))
+                    note = elem.get('_note')
+                    if note:
+                        node.note = note
+                    parent.children.append(node)
+                    node.parent = parent
+                    node_stack.append(node)
+            elif depth == 1 and elem.tag == 'body' and not seen_body:
+                seen_body = in_body = True
+                if doc_title:
+                    root = Node(doc_title.strip())
+            continue
+
+        # end event
+        elem_stack.pop()
+        if in_body:
+            if node_stack:
+                node_stack.pop()
+            else:
+                in_body = False
+        elif depth == 3 and elem.tag == 'title' and elem_stack[-1].tag == 'head' \
+                and not seen_title:
+            seen_title = True
+            doc_title = elem.text
+        if elem_stack:
+            elem.clear()
+            elem_stack[-1].remove(elem)
+
+    if not seen_body:
+        return [Node('Empty OPML')]
+    if root is not None:
+        roots.append(root)
+    return roots
+
+
 def parse_opml(root_elem: ET.Element, args: argparse.Namespace) -> List[Node]:
     roots: List[Node] = []
     head = root_elem.find('head')
@@ -0,0 +1,184 @@
+'''
+The filter expression language of --query and --queries.  An expression is made of
+
+    word, "quoted words"   the title contains the text (case sensitive, like --filter)
+    #tag                   the title has the tag (a word of the title, exactly)
+    /regex/ or /regex/i    the title matches the regular expression (i: ignoring case)
+    is:completed           the item is completed ([COMPLETE])
+    depth<N, depth=N ...   the depth of the item (top-level items are at depth 0),
+                           with one of < <= = != >= >
+    NOT x, x AND y, x OR y, (x)
+
+NOT binds tighter than AND, and AND tighter than OR; terms next to each other are ANDed.
+The operators are upper case, "and", "or" and "not" are words like the others.
+An expression is compiled once into a Matcher, a function of the node and its depth.
+'''
+
+import re
+from functools import lru_cache
+from typing import Callable, List, Tuple
+
+from .models import Node
+
+
+Matcher = Callable[[Node, int], bool]
+
+TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<paren>[()])
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | /(?P<regex>(?:[^/\\]|\\.)+)/(?P<flags>i?)(?=[\s()]|$)
+      | depth\s*(?P<op><=|>=|!=|==|=|<|>)\s*(?P<depth>\d+)(?=[\s()]|$)
+      | (?P<word>[^\s()"]+)
+    )''', re.VERBOSE)
+
+DEPTH_TESTS = {
+    '<': lambda depth, n: depth < n,
+    '<=': lambda depth, n: depth <= n,
+    '=': lambda depth, n: depth == n,
+    '==': lambda depth, n: depth == n,
+    '!=': lambda depth, n: depth != n,
+    '>=': lambda depth, n: depth >= n,
+    '>': lambda depth, n: depth > n,
+}
+
+
+def substring_matcher(text: str) -> Matcher:
+    return lambda node, depth: text in node.title
+
+
+def tag_matcher(tag: str) -> Matcher:
+    return lambda node, depth: tag in node.tags
+
+
+def regex_matcher(pattern: str, flags: str) -> Matcher:
+    search = re.compile(pattern, re.IGNORECASE if flags else 0).search
+    return lambda node, depth: search(node.title) is not None
+
+
+def completed_matcher(node: Node, depth: int) -> bool:
+    return node.title.startswith('[COMPLETE]')
+
+
+def depth_matcher(op: str, n: int) -> Matcher:
+    test = DEPTH_TESTS[op]
+    return lambda node, depth: test(depth, n)
+
+
+def tokenize(expression: str) -> List[Tuple[str, object]]:
+    '''(kind, value) pairs: ('(' or ')', None), ('AND'/'OR'/'NOT', None) or ('term', Matcher).'''
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN_RE.match(expression, pos)
+        if match is None:
+            raise ValueError(f"unexpected '{expression[pos:].strip()}'")
+        pos = match.end()
+        if match.group('paren'):
+            tokens.append((match.group('paren'), None))
+        elif match.group('quoted') is not None:
+            tokens.append(('term', substring_matcher(re.sub(r'\\(.)', r'\1', match.group('quoted')))))
+        elif match.group('regex') is not None:
+            try:
+                tokens.append(('term', regex_matcher(match.group('regex'), match.group('flags'))))
+            except re.error as e:
+                raise ValueError(f"bad regular expression /{match.group('regex')}/: {e}")
+        elif match.group('op'):
+            tokens.append(('term', depth_matcher(match.group('op'), int(match.group('depth')))))
+        else:
+            word = match.group('word')
+            if word in ('AND', 'OR', 'NOT'):
+                tokens.append((word, None))
+            elif word == 'is:completed':
+                tokens.append(('term', completed_matcher))
+            elif word.startswith('#') and len(word) > 1:
+                tokens.append(('term', tag_matcher(word)))
+            else:
+                tokens.append(('term', substring_matcher(word)))
+    return tokens
+
+
+@lru_cache(maxsize=256)
+def compile_query(expression: str) -> Matcher:
+    '''
+    The matcher of expression, see the top of this module.
+    Raises ValueError if the expression is not valid.
+    '''
+    tokens = tokenize(expression)
+    if not tokens:
+        raise ValueError("empty query")
+    pos = 0
+
+    def peek() -> str:
+        return tokens[pos][0] if pos < len(tokens) else ''
+
+    def parse_or() -> Matcher:
+        nonlocal pos
+        operands = [parse_and()]
+        while peek() == 'OR':
+            pos += 1
+            operands.append(parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda node, depth: any(operand(node, depth) for operand in operands)
+
+    def parse_and() -> Matcher:
+        nonlocal pos
+        operands = [parse_not()]
+        while peek() in ('AND', 'NOT', 'term', '('):
+            if peek() == 'AND':
+                pos += 1
+            operands.append(parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        if len(operands) == 2:
+            first, second = operands
+            return lambda node, depth: first(node, depth) and second(node, depth)
+        return lambda node, depth: all(operand(node, depth) for operand in operands)
+
+    def parse_not() -> Matcher:
+        nonlocal pos
+        kind = peek()
+        if kind == 'NOT':
+            pos += 1
+            operand = parse_not()
+            return lambda node, depth: not operand(node, depth)
+        if kind == 'term':
+            pos += 1
+            return tokens[pos - 1][1]
+        if kind == '(':
+            pos += 1
+            inner = parse_or()
+            if peek() != ')':
+                raise ValueError("missing ')'")
+            pos += 1
+            return inner
+        raise ValueError(f"expected a term, found {kind or 'the end of the query'}")
+
+    matcher = parse_or()
+    if pos < len(tokens):
+        raise ValueError(f"unexpected {tokens[pos][0]}")
+    return matcher
+
+
+def read_queries(path: str) -> List[Tuple[str, str]]:
+    '''
+    The named queries of a --queries file: one "name: expression" per line, blank lines and
+    lines starting with # are skipped.  Names are used for the output files.
+    Raises ValueError for a line that is not a query.
+    '''
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, sep, expression = line.partition(':')
+            name = name.strip()
+            if not sep or not re.fullmatch(r'[\w.-]+', name) or not expression.strip():
+                raise ValueError(f"{path}, line {number}: expected 'name: expression'")
+            if any(name == other for other, _ in queries):
+                raise ValueError(f"{path}, line {number}: query '{name}' is defined twice")
+            queries.append((name, expression.strip()))
+    return queries
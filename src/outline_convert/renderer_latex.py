@@ -1,16 +1,23 @@
 import argparse
 from datetime import datetime
 from inspect import cleandoc
-from typing import List
+from typing import Iterator, List, Optional
 import re
 
 from .models import Node
 from .utils import parse_item_text, link_replacer, convert_markdown_to_latex
+from .parallel import map_trees
+from .fragments import Entry, fragment_memo, iter_entries
+
 
 
 def render_latex(forest: List[Node], args: argparse.Namespace) -> List[str]:
-    lines: List[str] = []
-    lines.extend([
+    return list(iter_latex(forest, args))
+
+
+def iter_latex(forest: List[Node], args: argparse.Namespace) -> Iterator[str]:
+    """Yield the lines of render_latex one at a time."""
+    yield from [
         r"\documentclass{article}",
         r"\usepackage{enumitem}",
         r"\usepackage[T1]{fontenc}",
@@ -18,23 +25,23 @@ def render_latex(forest: List[Node], args: argparse.Namespace) -> List[str]:
         r"\newlist{tree}{itemize}{10}",
         r"\setlistdepth{10}",
         r"\setlist[tree]{label=\textbullet}",
-    ])
-    lines.append(r"\begin{tree}")
-    for tree in forest:
-        lines.extend(render_latex_tree(tree, args))
-
-    lines.append(r"\end{tree}")
-    lines.append(r"\end{document}")
+    ]
+    yield r"\begin{tree}"
+    for lines in map_trees(iter_latex_tree, forest, args):
+        yield from lines
 
-    return lines
+    yield r"\end{tree}"
+    yield r"\end{document}"
 
 
 def render_latex_tree(node: Node, args: argparse.Namespace, level: int = 0) -> List[str]:
-    lines: List[str] = []
+    return list(iter_latex_tree(node, args, level))
+
+
+def iter_latex_tree(node: Node, args: argparse.Namespace, level: int = 0) -> Iterator[str]:
+    entries: List[Entry] = []
     if level == 0:
-        title = node.title.strip()
-        if args.strip_tags:
-            title = ' '.join(part for part in title.split() if not part.startswith('#'))
+        title = node.plain_title if args.strip_tags else node.title.strip()
         title = parse_item_text(title, args)
         #if title.startswith('[COMPLETE]'):
         #    lines.append(r"\color{lightgray}")
@@ -43,15 +50,21 @@ def render_latex_tree(node: Node, args: argparse.Namespace, level: int = 0) -> L
             sep = '[]'
         else:
             sep = ''
-        lines.append(fr"\item{sep} {title}")
+        entries.append(fr"\item{sep} {title}")
+    entries.append((node, level))
+
+    return iter_entries(entries, lambda child, level: latex_tree_entries(child, args, level),
+                        fragment_memo('latex', args))
+
 
+def latex_tree_entries(node: Node, args: argparse.Namespace, level: int) -> List[Entry]:
+    '''The list of the children of node, deeper lists are left as (child, level) entries.'''
+    entries: List[Entry] = []
     has_children = node.children
     if has_children:
-        lines.append(fr"\begin{{tree}}")
+        entries.append(fr"\begin{{tree}}")
     for child in node.children:
-        title = child.title.strip()
-        if args.strip_tags:
-            title = ' '.join(part for part in title.split() if not part.startswith('#'))
+        title = child.plain_title if args.strip_tags else child.title.strip()
         title = parse_item_text(title, args)
         indent = '  ' * level
         # issue 65 (enhancement)
@@ -60,17 +73,17 @@ def render_latex_tree(node: Node, args: argparse.Namespace, level: int = 0) -> L
         else:
             sep = ''
 
-        lines.append(fr"{indent}\item{sep} {title}")
-        if child.note:
-            lines.append(fr"{indent}\begin{{quote}}")
-            lines.append(fr"{indent}{child.note}")
-            lines.append(fr"{indent}\end{{quote}}")
+        entries.append(fr"{indent}\item{sep} {title}")
+        if args.include_notes and child.note:
+            entries.append(fr"{indent}\begin{{quote}}")
+            entries.append(fr"{indent}{child.note}")
+            entries.append(fr"{indent}\end{{quote}}")
         if child.children:
-            lines.extend(render_latex_tree(child, args=args, level=level+1))
+            entries.append((child, level + 1))
     if has_children:
-        lines.append(fr"\end{{tree}}")
+        entries.append(fr"\end{{tree}}")
 
-    return lines
+    return entries
 
 
 IMAGE_RE = re.compile(r'!\[([^\]]+)\]\(([^\)]+)\)')
@@ -78,7 +91,11 @@ LINK_RE = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
 
 
 def render_latex_beamer(forest: List[Node], args: argparse.Namespace) -> List[str]:
-    lines: List[str] = []
+    return list(iter_latex_beamer(forest, args))
+
+
+def iter_latex_beamer(forest: List[Node], args: argparse.Namespace) -> Iterator[str]:
+    """Yield the lines of render_latex_beamer one at a time."""
         
     if not args.fragment:
         doc_title = parse_item_text(forest[0].title, args)
@@ -90,20 +107,19 @@ def render_latex_beamer(forest: List[Node], args: argparse.Namespace) -> List[st
             graphicspath = args.graphicspath
         
         today_str = datetime.now().strftime("%B %d, %Y")  # Example: August 15, 2025
-        lines.extend([
-            r"\documentclass{beamer}"])
+        yield r"\documentclass{beamer}"
         
         # deal with bibliography is specified
         if args.biblio:
             doc_biblio = args.biblio
-            lines.extend([
+            yield from [
                 r"\usepackage[backend=bibtex]{biblatex}",
                 fr"\addbibresource{{{doc_biblio}}}",
                 r"\renewcommand*{\bibfont}{\footnotesize}"
-            ])
+            ]
 
 
-        lines.extend([
+        yield from [
             r"\usepackage[T1]{fontenc}",
             r"\usepackage{graphicx}",
             r"\usetheme{Goettingen}",
@@ -133,78 +149,90 @@ def render_latex_beamer(forest: List[Node], args: argparse.Namespace) -> List[st
             r"\begin{frame}",
             r"  \titlepage",
             r"\end{frame}",
-        ])
+        ]
 
     i = 0
-    for tree in forest:
+    for lines, tree in zip(map_trees(iter_latex_beamer_tree, forest, args), forest):
         if i!=0:
             doc_title = parse_item_text(tree.title, args)
-            lines.extend([
+            yield from [
             fr"\title{{{doc_title}}}",
             r"\begin{frame}",
             r"  \titlepage",
             r"\end{frame}",
-            ])
-        lines.extend(render_latex_beamer_tree(tree, args))
+            ]
+        yield from lines
         i+=1
 
     if not args.fragment:
         # deal with bibliography is specified
         if args.biblio:
-            lines.extend([
+            yield from [
                 r"\begin{frame}{References}",
                 r"\begin{minipage}{1\linewidth}",
                 r"{\tiny \printbibliography}",
                 r"\end{minipage}",
                 r"\end{frame}"
-            ])
-        lines.append(r"\end{document}")
-
-    return lines
+            ]
+        yield r"\end{document}"
 
 
 def render_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int = 0, header_level: int = 0) -> List[str]:
-    lines: List[str] = []
+    return list(iter_latex_beamer_tree(node, args, level, header_level))
+
+
+def iter_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int = 0, header_level: int = 0) -> Iterator[str]:
+    return iter_entries([(node, level, header_level)],
+                        lambda child, level, header_level: beamer_tree_entries(child, args, level, header_level),
+                        fragment_memo('beamer', args))
+
+
+def beamer_tree_entries(node: Optional[Node], args: argparse.Namespace, level: int, header_level: int) -> List[Entry]:
+    '''
+    The output for the children of node, deeper levels are left as (child, level, header_level) entries.
+    (None, level, header_level) closes an indented tree: its line is only built when it is reached,
+    so that deep chains do not keep one per open level.
+    '''
+    if node is None:
+        return ['  ' * level + r"\end{tree}"]
+    entries: List[Entry] = []
 
 
 
     for child in node.children:
         title = child.title.strip()
-        tags = [part for part in title.split() if part.startswith('#')]
+        tags = child.tags
         if args.expert_mode:
             if "#h" in tags:
                 clean_title = parse_item_text(title, args)
                 if header_level == 0:
-                    lines.append(fr"\section{{{clean_title}}}")
-                    lines.extend(
-                        render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level + 1))
+                    entries.append(fr"\section{{{clean_title}}}")
+                    entries.append((child, level + 1, header_level + 1))
 
                 elif header_level == 1:
-                    lines.append(fr"\subsection{{{clean_title}}}")
-                    lines.extend(
-                        render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level + 1))
+                    entries.append(fr"\subsection{{{clean_title}}}")
+                    entries.append((child, level + 1, header_level + 1))
                 else:
-                    lines.append(fr"\subsubsection{{{clean_title}}}")
-                    lines.extend(
-                        render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level + 1))
+                    entries.append(fr"\subsubsection{{{clean_title}}}")
+                    entries.append((child, level + 1, header_level + 1))
 
             # There should not be any #h inside a slide node
 
             elif "#slide" in tags or level == 0:
                 clean_title = parse_item_text(title, args)
-                lines.append(fr"\begin{{frame}}{{{clean_title}}}")
+                entries.append(fr"\begin{{frame}}{{{clean_title}}}")
                 if child.children:
-                    lines.append(r"\begin{tree}")
-                    lines.extend(render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level))
-                    lines.append(r"\end{tree}")
-                lines.append(r"\end{frame}")
+                    entries.append(r"\begin{tree}")
+                    entries.append((child, level + 1, header_level))
+                    entries.append(r"\end{tree}")
+                entries.append(r"\end{frame}")
 
             else:
                 if args.parse_markdown:
                     i = IMAGE_RE.match(title)
                     if i:
                         file_location = i.group(2)
-                        lines.extend([
+                        entries.extend([
                             r"\begin{figure}[t]",
                             fr"\includegraphics[width=.75\textwidth]{{{file_location}}}",
                             r"\centering",
@@ -220,7 +248,7 @@ def render_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int =
                         else:
                             sep = ''
 
-                        lines.append(fr'\item{sep} {res}')
+                        entries.append(fr'\item{sep} {res}')
                         continue
 
                 indent = '  ' * level
@@ -228,39 +256,38 @@ def render_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int =
                 clean_title = parse_item_text(title, args)
                 #if clean_title.startswith('[COMPLETE]'):
                 #    print("complete item", clean_title)
-                #    lines.append(r"\color{lightgray}")
+                #    entries.append(r"\color{lightgray}")
                 # issue 65 (enhancement)
                 if (child.style == "normal"):
                     sep = '[]'
                 else:
                     sep = ''
 
-                lines.append(fr"{indent}\item{sep} {clean_title}")
+                entries.append(fr"{indent}\item{sep} {clean_title}")
                 if args.include_notes:
                     if child.note:
                         note = parse_item_text(child.note, args)
-                        lines.append(fr"{indent}\begin{{quote}}")
-                        lines.append(fr"{indent}{note}")
-                        lines.append(fr"{indent}\end{{quote}}")
+                        entries.append(fr"{indent}\begin{{quote}}")
+                        entries.append(fr"{indent}{note}")
+                        entries.append(fr"{indent}\end{{quote}}")
                 if child.children:
-                    lines.append(fr"{indent}\begin{{tree}}")
-                    lines.extend(render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level))
-                    lines.append(fr"{indent}\end{{tree}}")
+                    entries.append(fr"{indent}\begin{{tree}}")
+                    entries.append((child, level + 1, header_level))
+                    entries.append((None, level, header_level))
         else:
             if level == 0:
                 clean_title = parse_item_text(title, args)
-                lines.append(fr"\begin{{frame}}{{{clean_title}}}")
+                entries.append(fr"\begin{{frame}}{{{clean_title}}}")
                 if child.children:
-                    lines.append(r"\begin{tree}")
-                    lines.extend(
-                        render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level))
-                    lines.append(r"\end{tree}")
-                lines.append(r"\end{frame}")
+                    entries.append(r"\begin{tree}")
+                    entries.append((child, level + 1, header_level))
+                    entries.append(r"\end{tree}")
+                entries.append(r"\end{frame}")
             else:
                 i = IMAGE_RE.match(title)
                 if i:
                     file_location = i.group(2)
-                    lines.extend([
+                    entries.extend([
                         r"\begin{figure}[t]",
                         fr"\includegraphics[width=.75\textwidth]{{{file_location}}}",
                         r"\centering",
@@ -276,7 +303,7 @@ def render_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int =
                     else:
                         sep = ''
             
-                    lines.append(fr'\item{sep} {res}')
+                    entries.append(fr'\item{sep} {res}')
                     continue
 
                 indent = '  ' * level
@@ -287,17 +314,16 @@ def render_latex_beamer_tree(node: Node, args: argparse.Namespace, level: int =
                 else:
                     sep = ''
 
-                lines.append(fr"{indent}\item{sep} {clean_title}")
+                entries.append(fr"{indent}\item{sep} {clean_title}")
                 if args.include_notes:
                     if child.note:
                         note = parse_item_text(child.note, args)
-                        lines.append(fr"{indent}\begin{{quote}}")
-                        lines.append(fr"{indent}{note}")
-                        lines.append(fr"{indent}\end{{quote}}")
+                        entries.append(fr"{indent}\begin{{quote}}")
+                        entries.append(fr"{indent}{note}")
+                        entries.append(fr"{indent}\end{{quote}}")
                 if child.children:
-                    lines.append(fr"{indent}\begin{{tree}}")
-                    lines.extend(
-                        render_latex_beamer_tree(child, args=args, level=level + 1, header_level=header_level))
-                    lines.append(fr"{indent}\end{{tree}}")
+                    entries.append(fr"{indent}\begin{{tree}}")
+                    entries.append((child, level + 1, header_level))
+                    entries.append((None, level, header_level))
 
-    return lines
+    return entries
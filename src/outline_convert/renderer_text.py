@@ -1,121 +1,143 @@
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 from .models import Node
-import xml.etree.ElementTree as ET
-from .utils import indent, node_to_outline_elem
+from .utils import escape_xml_attribute, escape_xml_text
+from .parallel import map_trees
+from .fragments import Entry, fragment_memo, iter_entries
 import argparse
 
 
 def render_text(forest: List[Node], args: argparse.Namespace) -> List[str]:
-    lines: List[str] = []
-    for tree in forest:
-        lines += (render_text_tree(tree, args))
-    return lines
+    return list(iter_text(forest, args))
+
+
+def iter_text(forest: List[Node], args: argparse.Namespace) -> Iterator[str]:
+    """Yield the lines of render_text one at a time."""
+    for lines in map_trees(iter_text_tree, forest, args):
+        yield from lines
 
 
 def render_text_tree(node: Node, args: argparse.Namespace, level: int = 0)-> List[str]:
-    lines: List[str] = []
+    return list(iter_text_tree(node, args, level))
+
+
+def iter_text_tree(node: Node, args: argparse.Namespace, level: int = 0) -> Iterator[str]:
     if not node:
-        return lines
-    title = node.title
-    if args.strip_tags:
-        title = ' '.join(part for part in title.split() if not part.startswith('#'))
-    indent = args.indent_string * level
-    if level == 0:
-        lines.append(title)
+        return iter(())
+    memo = fragment_memo('txt', args)
+    if memo is not None:
+        return iter_entries([(node, level)], lambda node, depth: text_tree_entries(node, args, depth), memo)
+    # the plain walk is much cheaper than going through entries
+    return walk_text_tree(node, args, level)
+
+
+def walk_text_tree(node: Node, args: argparse.Namespace, level: int) -> Iterator[str]:
+    nodeStack = [(node, level)]
+    while nodeStack:
+        currentNode, depth = nodeStack.pop()
+        title = currentNode.plain_title if args.strip_tags else currentNode.title
+        indent = args.indent_string * depth
+        if depth == 0:
+            yield title
+        else:
+            bullet_prefix = args.bullet_symbol + ' '
+            yield indent + bullet_prefix + title
+
+        if currentNode.note and args.include_notes:
+            yield indent + f'"{currentNode.note}"'
+
+        for child in reversed(currentNode.children):
+            nodeStack.append((child, depth + 1))
+
+
+def text_tree_entries(node: Node, args: argparse.Namespace, depth: int) -> List[Entry]:
+    """The lines of node, its children are left as (child, depth) entries: walk_text_tree for iter_entries."""
+    title = node.plain_title if args.strip_tags else node.title
+    indent = args.indent_string * depth
+    if depth == 0:
+        entries: List[Entry] = [title]
     else:
         bullet_prefix = args.bullet_symbol + ' '
-        lines.append(indent + bullet_prefix + title)
+        entries = [indent + bullet_prefix + title]
 
     if node.note and args.include_notes:
-        lines.append(indent + f'"{node.note}"')
-
-    for child in node.children:
-        lines.extend(render_text_tree(child, args, level + 1))
-
-    return lines
-
-
-def render_opml(forest: List[Node], args: argparse.Namespace) -> ET.ElementTree:
-    # Create the root OPML structure only at the top level
-    opml = ET.Element('opml', version='2.0')
-    head = ET.SubElement(opml, 'head')
-    if args.email:
-        em = ET.SubElement(head, 'ownerEmail')
-        em.text = args.email
-    body = ET.SubElement(opml, 'body')
-
-    for tree in forest:
-        element = render_opml_tree(tree, args)
-        body.append(element)
-
-    # Format and return the complete tree
-    document = ET.ElementTree(opml)
-    try:
-        ET.indent(document, space='  ')
-    except AttributeError:
-        indent(opml)
-    return document
-
-def render_opml_tree(node: Node, args: argparse.Namespace) -> ET.Element:
-        elem = node_to_outline_elem(node, args)
-        # Add children recursively
-        for child in node.children:
-            child_elem = render_opml_tree(child, args)
-            elem.append(child_elem)
-        return elem
-
-
-
+        entries.append(indent + f'"{node.note}"')
 
+    entries.extend((child, depth + 1) for child in node.children)
+    return entries
 
 
+OPML_HEADER = ["<?xml version='1.0' encoding='utf-8'?>", '<opml version="2.0">']
 
 
-
-
-
-
-
-
-
-
-def render_opml_tree_former(node: Node, args: argparse.Namespace, level: int = 0) -> ET.ElementTree:
-    """Recursively render nodes to OPML, similar to render_text pattern"""
-    if level == 0:
-        # Create the root OPML structure only at the top level
-        opml = ET.Element('opml', version='2.0')
-        head = ET.SubElement(opml, 'head')
-        if args.email:
-            em = ET.SubElement(head, 'ownerEmail')
-            em.text = f"\n      {args.email}\n    "
-        body = ET.SubElement(opml, 'body')
-
-        # Add the root node
-        root_elem = node_to_outline_elem(node, args)
-        body.append(root_elem)
-
-        # Recursively add children to the root element
-        for child in node.children:
-            child_tree = render_opml_tree_former(child, args, level + 1)
-            root_elem.append(child_tree)
-
-        # Format and return the complete tree
-        tree = ET.ElementTree(opml)
-        try:
-            ET.indent(tree, space='  ')
-        except AttributeError:
-            indent(opml)
-        return tree
+def iter_opml(forest: List[Node], args: argparse.Namespace) -> Iterator[str]:
+    """
+    Yield the lines of the OPML document, indented by two spaces like ET.indent does.
+    The outlines are written while the trees are walked, no element tree is built.
+    """
+    yield from OPML_HEADER
+    if args.email:
+        yield '  <head>'
+        yield f'    <ownerEmail>{escape_xml_text(args.email)}</ownerEmail>'
+        yield '  </head>'
+    else:
+        yield '  <head />'
+    if not forest:
+        yield '  <body />'
     else:
-        # For recursive calls, just return the element for this node
-        elem = node_to_outline_elem(node, args)
+        yield '  <body>'
+        for lines in map_trees(iter_opml_tree, forest, args):
+            yield from lines
+        yield '  </body>'
+    yield '</opml>'
 
-        # Add children recursively
-        for child in node.children:
-            child_elem = render_opml_tree_former(child, args, level + 1)
-            elem.append(child_elem)
 
-        return elem
+def iter_opml_tree(node: Node, args: argparse.Namespace, level: int = 0) -> Iterator[str]:
+    if not node:
+        return iter(())
+    memo = fragment_memo('opml', args)
+    if memo is not None:
+        return iter_entries([(node, level)], lambda node, depth: opml_tree_entries(node, args, depth), memo)
+    return walk_opml_tree(node, args, level)
+
+
+def outline_attributes(node: Node, args: argparse.Namespace) -> str:
+    title = node.plain_title if args.strip_tags else node.title
+    attributes = f'text="{escape_xml_attribute(title)}"'
+    if args.include_notes and node.note:
+        attributes += f' _note="{escape_xml_attribute(node.note)}"'
+    return attributes
+
+
+def walk_opml_tree(node: Node, args: argparse.Namespace, level: int) -> Iterator[str]:
+    # (None, depth) closes the outline at depth, once its children are written; the closing
+    # line is only built then, so that deep chains do not keep one per open outline
+    nodeStack: List[Tuple[Optional[Node], int]] = [(node, level)]
+    while nodeStack:
+        currentNode, depth = nodeStack.pop()
+        indent = '  ' * (depth + 2)
+        if currentNode is None:
+            yield indent + '</outline>'
+            continue
+        if not currentNode.children:
+            yield f'{indent}<outline {outline_attributes(currentNode, args)} />'
+            continue
+        yield f'{indent}<outline {outline_attributes(currentNode, args)}>'
+        nodeStack.append((None, depth))
+        for child in reversed(currentNode.children):
+            nodeStack.append((child, depth + 1))
+
+
+def opml_tree_entries(node: Optional[Node], args: argparse.Namespace, depth: int) -> List[Entry]:
+    """The lines of node around (child, depth) entries for its children: walk_opml_tree for iter_entries."""
+    indent = '  ' * (depth + 2)
+    if node is None:
+        return [indent + '</outline>']
+    if not node.children:
+        return [f'{indent}<outline {outline_attributes(node, args)} />']
+    entries: List[Entry] = [f'{indent}<outline {outline_attributes(node, args)}>']
+    entries.extend((child, depth + 1) for child in node.children)
+    entries.append((None, depth))
+    return entries
 
 
@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import stat
+import sys
+import xml.etree.ElementTree as ET
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import date
+from typing import Hashable, List, Optional
+
+from .cache import LRU
+from .fragments import FRAGMENTS
+from .models import Node
+from .parser import build_text_tree, detect_format, iter_text_chunks, parse_opml_stream
+from .main import (InputFormatError, add_conversion_arguments, convert_forest, evict_ai_cache, handle_ai_prompts,
+                   render_forest)
+from .utils import preprocess_forest
+
+# options that only change how a converted forest is rendered or reported, see options_key
+RENDER_OPTIONS = {'format', 'email', 'author', 'graphicspath', 'biblio', 'fragment', 'debug', 'test',
+                  'parse_only', 'add_new_line', 'jobs', 'ai_concurrency'}
+
+
+def digest(*parts: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode('utf-8', 'surrogatepass'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def options_key(args: argparse.Namespace, render: bool) -> Hashable:
+    '''The options a conversion depends on; with render=False the rendering only ones are left out.'''
+    return tuple(sorted((name, value) for name, value in vars(args).items()
+                        if render or name not in RENDER_OPTIONS))
+
+
+class ConversionServer:
+    '''
+    The warm state of outline-convert serve, kept between requests:
+    - whole outputs, keyed on the document and all the options;
+    - rendered subtrees, see fragments.FRAGMENTS;
+    - converted (pruned, preprocessed, prompts answered) trees of text documents, per top-level
+      tree of the input, so after an edit only the trees that changed are parsed and converted
+      again.  Without --start, --filter and --query the trees of a text outline are converted independently
+      of each other (as in streamed conversions), otherwise and for OPML the whole converted
+      forest is kept instead.
+    Converted trees are never modified by the renderers, so they are shared between requests.
+    '''
+
+    def __init__(self, max_outputs: int = 64, max_trees: int = 100000):
+        self.outputs = LRU(max_outputs)
+        self.trees = LRU(max_trees)
+        FRAGMENTS.enabled = True
+        self.parser = argparse.ArgumentParser(prog='outline-convert serve', add_help=False)
+        self.parser.add_argument('-f', '--format', choices=['txt', 'opml', 'latex', 'beamer'], default='txt')
+        add_conversion_arguments(self.parser)
+
+    def handle(self, request: dict) -> dict:
+        '''Answer one request: {"text" or "path", optional "name" and "args"} -> {"output", "log"}.'''
+        log = io.StringIO()
+        response = {'id': request.get('id'), 'ok': False}
+        try:
+            # stdout may be the channel of the answers, everything printed goes to the log
+            with redirect_stdout(log), redirect_stderr(log):
+                response['output'] = self.convert(request)
+            response['ok'] = True
+        except SystemExit:
+            response['error'] = 'invalid arguments'   # argparse explains it in the log
+        except Exception as e:
+            response['error'] = f"{type(e).__name__}: {e}"
+        response['log'] = log.getvalue()
+        return response
+
+    def convert(self, request: dict) -> str:
+        args = self.parser.parse_args(request.get('args', []))
+        args.clipboard = False
+        args.output = None
+        name = request.get('name') or request.get('path')
+        if 'text' in request:
+            text = request['text']
+        else:
+            with open(request['path'], encoding='utf-8') as f:
+                text = f.read()
+
+        doc = digest(text, name or '')
+        # latex and beamer outputs are dated
+        key = (doc, options_key(args, render=True), date.today())
+        output = self.outputs.get(key)
+        if output is not None:
+            if args.debug:
+                print("output cache hit")
+            return output
+
+        forest = self.convert_document(doc, text, name, args)
+        evict_ai_cache(args)
+        output = '\n'.join(render_forest(forest, args))
+        counts = FRAGMENTS.report()
+        if args.debug:
+            print(counts)
+        self.outputs.put(key, output)
+        return output
+
+    def convert_document(self, doc: str, text: str, name: Optional[str], args: argparse.Namespace) -> List[Node]:
+        options = options_key(args, render=False)
+        input_format = args.input_format
+        if input_format == 'auto':
+            input_format = detect_format(io.StringIO(text), name)
+
+        if input_format == 'opml' or args.start or args.filter or args.query:
+            forest = self.trees.get((doc, options))
+            if forest is not None:
+                if args.debug:
+                    print("converted forest cache hit")
+                return forest
+            if input_format == 'opml':
+                try:
+                    forest = parse_opml_stream(io.StringIO(text), args)
+                except ET.ParseError as e:
+                    if args.input_format == 'opml':
+                        raise InputFormatError(f"input is not valid OPML: {e}")
+            if forest is None:
+                forest = [build_text_tree(*chunk) for chunk in iter_text_chunks(text.splitlines())]
+            forest = convert_forest(forest, args)
+            self.trees.put((doc, options), forest)
+            return forest
+
+        forest = []
+        hits = misses = 0
+        for chunk in iter_text_chunks(text.splitlines()):
+            tokens, indent_size = chunk
+            key = (digest(str(indent_size), *(line for _, _, line in tokens)), options)
+            trees = self.trees.get(key)
+            if trees is None:
+                misses += 1
+                trees = handle_ai_prompts(preprocess_forest([build_text_tree(*chunk)], args), args)
+                self.trees.put(key, trees)
+            else:
+                hits += 1
+            forest.extend(trees)
+        if args.debug:
+            print(f"converted trees: {hits} cached, {misses} converted")
+        return forest
+
+
+def serve_main(argv: List[str]) -> int:
+    '''
+    outline-convert serve: answer conversion requests, one JSON object per line, on stdin or on
+    a Unix socket, keeping parsed and converted outlines and outputs cached between requests.
+    '''
+    p = argparse.ArgumentParser(prog='outline-convert serve',
+                                description='Answer JSON-lines conversion requests on stdin or a Unix socket')
+    p.add_argument('--socket', metavar='PATH', help='Listen on the Unix socket PATH instead of stdin')
+    p.add_argument('--max-outputs', type=int, default=64, metavar='N',
+                   help='Number of outputs kept in memory')
+    p.add_argument('--max-trees', type=int, default=100000, metavar='N',
+                   help='Number of converted trees kept in memory')
+    options = p.parse_args(argv)
+    server = ConversionServer(options.max_outputs, options.max_trees)
+
+    if not options.socket:
+        serve_stream(server, sys.stdin, sys.stdout)
+        return 0
+
+    import socket
+    import socketserver
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.exit("Error: Unix sockets are not available on this platform, serve on stdin instead")
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stream(server, io.TextIOWrapper(self.rfile, encoding='utf-8'),
+                         io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True))
+
+    remove_socket(options.socket)
+    # one connection at a time: requests share the caches and the process wide stdout redirection
+    with socketserver.UnixStreamServer(options.socket, Handler) as unix_server:
+        print(f"Listening on {options.socket}", file=sys.stderr)
+        try:
+            unix_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            remove_socket(options.socket)
+    return 0
+
+
+def remove_socket(path: str):
+    '''Remove the Unix socket at path, if any; anything else at path is left alone and is an error.'''
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        sys.exit(f"Error: {path} exists and is not a socket, not removing it")
+    os.remove(path)
+
+
+def serve_stream(server: ConversionServer, rfile, wfile):
+    '''Answer the requests read from rfile, one JSON object per line, on wfile.'''
+    for line in rfile:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request is a JSON object")
+        except ValueError as e:
+            response = {'id': None, 'ok': False, 'error': f"bad request: {e}"}
+        else:
+            response = server.handle(request)
+        wfile.write(json.dumps(response) + '\n')
+        wfile.flush()
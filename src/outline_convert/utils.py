@@ -2,135 +2,89 @@
 import time
 import os
 import argparse
-from math import gcd
-from typing import List, Optional
+from functools import lru_cache
+from typing import Callable, List, Optional
 
 
-from .models import Node, TextSegment
+from .models import Node, tag_of
 import xml.etree.ElementTree as ET
 import re
 
 
-def detect_indent(lines: List[str]) -> int:
-    counts = [len(l) - len(l.lstrip(' ')) for l in lines if l.startswith(' ')]
-    if not counts:
-        return 1
-    indent = counts[0]
-    for c in counts[1:]:
-        indent = gcd(indent, c)
-    return indent or 1
-
-def compute_level(line: str, indent_size: int) -> int:
-    leading = line.expandtabs(indent_size)
-    space_count = len(leading) - len(leading.lstrip(' '))
-    extra = indent_size if leading.lstrip().startswith('-') else 0
-    level = (space_count + extra) // indent_size
-    return level
-
 # -- TREE UTILITIES ---------------------------------------------------------
 
-def find_node(forest: List[Node], prefix: str) -> List[Node]:
-    for tree in forest:
-        result = find_node_tree(tree, prefix)
-        if result is not None:
-            return [result]
-    return []
-
-def find_node_tree(node: Node, prefix: str) -> Optional[Node]:
-    if node.title.startswith(prefix):
-        return node
-    for child in node.children:
-        result = find_node_tree(child, prefix)
-        if result is not None:
-            return result
-    return None
-#find all the nodes with this substring
-def find_sub_string(node: Node, substring: str) -> List[Node]:
-    res = []
-    if substring in node.title:
-        res.append(node)
-    for child in node.children:
-        res.extend(find_sub_string(child, substring))
-    return res
-
-#returns the path to the node including its subtree
-def get_path(node: Node) -> List[Node]:
-    res = []
-    if node:
-        current = node
-        while node.parent is not None:
-            #here is the line that keeps the subTree
-            #use current = node.title if we only want to keep the title
-            parent = Node(node.parent.title)
-            parent.children.append(current)
-            current = parent
-            node = node.parent
-        res.append(current)
-    return res
-
-
-def copy_subtree(node: Node) -> Node:
-    new_node = Node(node.title)
-    for child in node.children:
-        copied_child = copy_subtree(child)
-        copied_child.parent = new_node
-        new_node.children.append(copied_child)
-    return new_node
-
-def filter_tree(node: Node, substring: str) -> Optional[Node]:
-    if substring in node.title:
-        return copy_subtree(node)
-
-    kept_children: List[Node] = []
-    for child in node.children:
-        filtered_child = filter_tree(child, substring)
-        if filtered_child:
-            #filtered_child.parent = None
-            kept_children.append(filtered_child)
-
-    if kept_children:
-        new_node = Node(node.title)
-        for c in kept_children:
-            c.parent = new_node
-            new_node.children.append(c)
-        return new_node
-
-    return None
-
-def filter(forest: List[Node], substring: str) -> List[Node]:
-    result: List[Node] = []
-    for tree in forest:
-        filtered = filter_tree(tree, substring)
-        if filtered:
-            result.append(filtered)
-    return result
+'''
+Filter the forest with several matchers in a single walk.  For every matcher (a function of the
+node and its depth, top-level nodes are at depth 0, see query.py) the result holds the subtrees
+of the nodes it matches, together with the paths leading to them.
+The walk is in post-order with an explicit stack: each entry holds a node, an iterator over its
+children, its depth, the matchers that still look for nodes below it (as a bit mask) and the
+kept children collected so far, per matcher.  A subtree is only visited while some matcher has
+not matched a node above it.
+The nodes kept are the nodes of the forest, with their notes and styles.  With a single matcher
+nothing is copied, only the child lists of the nodes on the paths are replaced by the kept
+children: the trees are not usable unfiltered afterwards.  With several matchers the nodes on the
+paths are copied (one new node per result that keeps them, linked to the copy of their parent),
+the matching subtrees are shared.
+'''
+def filter_forests(forest: List[Node], matchers: List[Callable[[Node, int], bool]]) -> List[List[Node]]:
+    results: List[List[Node]] = [[] for _ in matchers]
+    in_place = len(matchers) == 1
+    numbered = list(enumerate(matchers))
+    only = matchers[0] if in_place else None
+    nodeStack = [(None, iter(forest), -1, (1 << len(matchers)) - 1, dict(enumerate(results)))]
+    while nodeStack:
+        currentNode, children, depth, looking, kept = nodeStack[-1]
+        child = next(children, None)
+        if child is not None:
+            if in_place:   # the common case, without the bookkeeping
+                if only(child, depth + 1):
+                    kept.setdefault(0, []).append(child)
+                elif child.children:
+                    nodeStack.append((child, iter(child.children), depth + 1, 1, {}))
+                continue
+            remaining = looking
+            for i, matcher in numbered:
+                if looking >> i & 1 and matcher(child, depth + 1):
+                    kept.setdefault(i, []).append(child)
+                    remaining &= ~(1 << i)
+            if remaining and child.children:
+                nodeStack.append((child, iter(child.children), depth + 1, remaining, {}))
+            continue
 
+        nodeStack.pop()
+        if currentNode is None:
+            break
+        parent_kept = nodeStack[-1][4]
+        for i, kept_children in kept.items():
+            if in_place:
+                path_node = currentNode
+            else:
+                path_node = Node(currentNode.title)
+                path_node.note = currentNode.note
+                path_node.style = currentNode.style
+                for c in kept_children:
+                    if c.parent is None:   # a copy on the path, copies start without a parent
+                        c.parent = path_node
+            path_node.children = kept_children
+            parent_kept.setdefault(i, []).append(path_node)
+    return results
 
 def parse_opml_children(elem: ET.Element, parent: Node):
-    for child_elem in elem.findall('outline'):
-        title = child_elem.get('text', '')
-        node = Node(title)
-        note = child_elem.get('_note')
-        if note:
-            node.note = note
-
-        parent.children.append(node)
-        node.parent = parent
-        parse_opml_children(child_elem, node)
+    elemStack = [(elem, parent)]
+    while elemStack:
+        currentElem, currentNode = elemStack.pop()
+        for child_elem in currentElem.findall('outline'):
+            title = child_elem.get('text', '')
+            node = Node(title)
+            note = child_elem.get('_note')
+            if note:
+                node.note = note
+
+            currentNode.children.append(node)
+            node.parent = currentNode
+            elemStack.append((child_elem, node))
     
-# -- PRETTY INDENT ----------------------------------------------------------
-def indent(elem: ET.Element, level: int = 0):
-    pad = '\n' + level * '  '
-    if elem:
-        if not elem.text or not elem.text.strip():
-            elem.text = pad + '  '
-        for c in elem:
-            indent(c, level+1)
-        if not elem[-1].tail or not elem[-1].tail.strip():
-            elem[-1].tail = pad
-    if level and (not elem.tail or not elem.tail.strip()):
-        elem.tail = pad
-
 # -- FILENAME SANITIZE -----------------------------------------------------
 def sanitize_filename(s: str) -> str:
     name = re.sub(r"\s+", '_', s.strip())
@@ -140,183 +94,154 @@ def sanitize_filename(s: str) -> str:
 import re
 
 
+# One pass over the text with str.translate.  The table gives the output of the historical chain
+# of str.replace calls, which escaped backslashes first and then the braces of \textbackslash{}:
+# test/test_escape_latex.py checks that they agree, test/bench_escape_latex.py times them.
+# Most words have no special character at all, those are found by a regex search and returned
+# as they are, without building a new string.
+LATEX_ESCAPES = str.maketrans({
+    '\\': r'\textbackslash\{\}',
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\textasciicircum{}',
+})
+LATEX_SPECIAL_RE = re.compile(r'[\\&%$#_{}~^]')
+
+
 def escape_latex(text: str) -> str:
-    return text.replace('\\', r'\textbackslash{}') \
-        .replace('&', r'\&') \
-        .replace('%', r'\%') \
-        .replace('$', r'\$') \
-        .replace('#', r'\#') \
-        .replace('_', r'\_') \
-        .replace('{', r'\{') \
-        .replace('}', r'\}') \
-        .replace('~', r'\textasciitilde{}') \
-        .replace('^', r'\textasciicircum{}')
+    if LATEX_SPECIAL_RE.search(text) is None:
+        return text
+    return text.translate(LATEX_ESCAPES)
+
+# The escapes of ElementTree, so that the OPML written directly is the same as it used to be:
+# ampersands first, and in attributes the white space that XML would otherwise normalize.
+def escape_xml_text(text: str) -> str:
+    return text.replace('&', '&amp;') \
+        .replace('<', '&lt;') \
+        .replace('>', '&gt;')
+
+def escape_xml_attribute(text: str) -> str:
+    return text.replace('&', '&amp;') \
+        .replace('<', '&lt;') \
+        .replace('>', '&gt;') \
+        .replace('"', '&quot;') \
+        .replace('\r', '&#13;') \
+        .replace('\n', '&#10;') \
+        .replace('\t', '&#09;')
+
+MD_BOLD_RE = re.compile(r'\*\*(.*?)\*\*', flags=re.DOTALL)
+MD_ITALIC1_RE = re.compile(r'\*(.*?)\*', flags=re.DOTALL)
+MD_ITALIC2_RE = re.compile(r'__(.*?)__', flags=re.DOTALL)
 
 def convert_markdown_to_latex(s: str) -> str:
-    s = re.sub(r'\*\*(.*?)\*\*', r'\\textbf{\1}', s, flags=re.DOTALL) # markdown: **bold text**
-    s = re.sub(r'\*(.*?)\*', r'\\textit{\1}', s, flags=re.DOTALL) # markdown: *italic text*
-    s = re.sub(r'__(.*?)__', r'\\textit{\1}', s, flags=re.DOTALL) # markdown: __italic text__
+    s = MD_BOLD_RE.sub(r'\\textbf{\1}', s) # markdown: **bold text**
+    s = MD_ITALIC1_RE.sub(r'\\textit{\1}', s) # markdown: *italic text*
+    s = MD_ITALIC2_RE.sub(r'\\textit{\1}', s) # markdown: __italic text__
 
     return s
 
-def split_segments(segments: List[TextSegment], pattern: re.Pattern, new_type: str) -> List[TextSegment]:
-    res: List[TextSegment] = []
-    for segment in segments:
-        if segment.type != 'plain':
-            res.append(segment)
-            continue
-
-        parts = pattern.split(segment.text)
-        for part in parts:
-            if pattern.fullmatch(part):
-                res.append(TextSegment(part, new_type))
-            else:
-                res.append(TextSegment(part, 'plain'))
-    return res
+DISPLAY_MATH_RE = re.compile(r'\$\$(.*?)\$\$', flags=re.DOTALL)
+# Inline markup that is copied as is rather than escaped, in order of precedence: each pattern only
+# applies to the plain text left over by the ones before it
+ITEM_MARKUP = [
+    ('math', re.compile(r'\$.*?\$', flags=re.DOTALL)),
+    ('citation', re.compile(r'\\cite{.*?}', flags=re.DOTALL)),
+    ('md_bold', re.compile(r'\*\*.*?\*\*', flags=re.DOTALL)),
+    ('md_italic1', re.compile(r'\*.*?\*', flags=re.DOTALL)),
+    ('md_italic2', re.compile(r'__.*?__', flags=re.DOTALL)),
+]
 
 
 def parse_item_text(title: str, args: argparse.Namespace) -> str:
-    s = re.sub(r'\$\$(.*?)\$\$', r'$\1$', title, flags=re.DOTALL)
-    # List of new types and RegExp
-    patterns = [
-        ('math', re.compile(r'(\$.*?\$)', flags=re.DOTALL)),
-        ('citation', re.compile(r'(\\cite{.*?})', flags=re.DOTALL)),
-        ('md_bold', re.compile(r'(\*\*.*?\*\*)', flags=re.DOTALL)),
-        ('md_italic1', re.compile(r'(\*.*?\*)', flags=re.DOTALL)),
-        ('md_italic2', re.compile(r'(__.*?__)', flags=re.DOTALL)),
-    ]
-
-    segments = [TextSegment(s, 'plain')]
+    return format_item_text(title, args.parse_markdown, args.strip_tags, args.format in ['latex', 'beamer'])
+
+
+@lru_cache(maxsize=65536)
+def format_item_text(title: str, parse_markdown: bool, strip_tags: bool, escape: bool) -> str:
+    '''
+    Markup spans are kept whole (markdown is converted to LaTeX when parse_markdown is set), the
+    plain text in between is split into words and LaTeX escaped when escape is set.  With
+    strip_tags the words of the #tags (see models.tag_of) are dropped first.
+    Spans are (start, end, type) index ranges into the title, so no intermediate strings are
+    built until the words are emitted.  Outlines repeat many titles, so results are cached.
+    '''
+    if strip_tags and '#' in title:
+        # the words title_tags takes as tags, markup or not
+        title = ' '.join([word for word in title.split() if tag_of(word) is None])
+    s = DISPLAY_MATH_RE.sub(r'$\1$', title)
 
     # Step 1: Splitting between laTeX and non LaTeX
-    for (type, pattern) in patterns:
-        segments = split_segments(segments, pattern, type)
-
-    # Step 2: Markdown parsing
-    if args.parse_markdown:
-        for segment in segments:
-            if segment.type.startswith('md_'):
-                segment.text = convert_markdown_to_latex(segment.text)
-                segment.type = 'markdown_parsed' # flag that there is no need to escape the converted markdown
-
-    # Step 3: Flatten plain segments to words and remove #tags
-    flattened: List[TextSegment] = []
-    for seg in segments:
-        if seg.type == 'plain':
-            for word in seg.text.split():
-                if args.strip_tags and word.startswith('#'):
-                    continue
-                flattened.append(TextSegment(word, 'plain'))
+    spans = [(0, len(s), 'plain')]
+    for (type, pattern) in ITEM_MARKUP:
+        split = []
+        for (start, end, span_type) in spans:
+            if span_type != 'plain':
+                split.append((start, end, span_type))
+                continue
+            for match in pattern.finditer(s, start, end):
+                split.append((start, match.start(), 'plain'))
+                split.append((match.start(), match.end(), type))
+                start = match.end()
+            split.append((start, end, 'plain'))
+        spans = split
+
+    # Step 2: plain text to words, escaped; markup as is, or parsed markdown
+    words: List[str] = []
+    for (start, end, span_type) in spans:
+        text = s[start:end]
+        if span_type == 'plain':
+            for word in text.split():
+                words.append(escape_latex(word) if escape else word)
+        elif parse_markdown and span_type.startswith('md_'):
+            words.append(convert_markdown_to_latex(text))
         else:
-            flattened.append(seg)
-    segments = flattened
+            words.append(text)
 
-    # Step 4: Non LaTeX escaping
-    if args.format in ['latex', 'beamer']:
-        for segment in segments:
-            if segment.type == 'plain':
-                segment.text = escape_latex(segment.text)
-
-    # Step 5: Join back with spaces 
-    return ' '.join(segment.text for segment in segments)
+    # Step 3: Join back with spaces
+    return ' '.join(words)
 
 
 def link_replacer(match):
     text, url = match.group(1), match.group(2)
     return fr"\href{{{url}}}{{{escape_latex(text)}}}"
 
-def node_to_outline_elem(node: Node, args: argparse.Namespace) -> ET.Element:
-    """Convert a single node to an outline element (no children processing)"""
-    elem = ET.Element('outline')
-    title = node.title
-    if args.strip_tags:
-        title = ' '.join(part for part in title.split() if not part.startswith('#'))
-    elem.set('text', title)
-    if args.include_notes and node.note:
-        elem.set('_note', node.note)
-    return elem
-
 IGNORE_OUTLINE_TAGS = {"#wfe-ignore-outline", "#ignore-outline"}
 IGNORE_ITEM_TAGS = {"#wfe-ignore-item", "#ignore-item", "#hh"}
 
 
-'''
-I could be wrong, but the purpose of ignore_tree seems to be to process a tree in such a way that
-any node not to be translated gets removed from the tree.
-I suppose that's why it's called ignore_tree.
-You could also think of it as pruning.
-'''
-def ignore_tree(node: Node, args: argparse.Namespace):
+def is_ignored_item(node: Node, args: argparse.Namespace) -> bool:
+    '''This item is dropped but its children are kept, in its place.'''
     is_complete = node.title.startswith('[COMPLETE]')
-    has_children = bool(node.children)
-    children_copy = list(node.children) if has_children else []
-    ignore_item = (args.hide_completed and is_complete) or \
+    return (args.hide_completed and is_complete) or \
         (args.completed_only and not is_complete) or \
-        (args.expert_mode and any(tag in node.title for tag in IGNORE_ITEM_TAGS))
-
-    # if this line to be ignored, then just process the children and return
-    if ignore_item:
-        if node.parent:
-            parent = node.parent
-            index = parent.children.index(node)
-            parent.children[index:index + 1] = children_copy
-            if has_children:
-                for child in node.children:
-                    child.parent = parent
-            for child in children_copy:
-                ignore_tree(child, args)
-            return
-
-    # if this whole subtree to be ignored then remove it and return
-    if args.expert_mode and any(tag in node.title for tag in IGNORE_OUTLINE_TAGS):
-        if node.parent:
-            node.parent.children.remove(node)
-            return
-
-    # recurse
-    if has_children:
-        for child in children_copy:
-            ignore_tree(child, args)
-
-'''
-ignore_forest is called once per separate tree, where the source contains more than one tree.  The 
-collection of trees is not the same as children of a node: it refers to output from editors such as 
-Dynalist, which uses documents rather than large subtrees.  
-(So for example, a collection of documents corresponds to a forest.)
-'''
-def ignore_forest(forest: List[Node], args: argparse.Namespace) -> List[Node]:
-    result = []
-    for node in forest:
-        is_complete = node.title.startswith('[COMPLETE]')
-        ignore_item = (args.hide_completed and is_complete) or \
-                      (args.completed_only and not is_complete) or \
-                      (args.expert_mode and any(tag in node.title for tag in IGNORE_ITEM_TAGS))
-
-        if ignore_item:
-            result.extend(node.children if node.children else [])
-            continue
-
-        if args.expert_mode and any(tag in node.title for tag in IGNORE_OUTLINE_TAGS):
-            continue
-
-        # issue #65: deal with style to suppress item in beamer (more expected to come)
-        # note, this only applies to the very top of a document tree -- 
-        #   style setting for all sub-nodes is done else where: in preprocess_tree for now
-        if args.expert_mode and any(tag in node.title for tag in ['#style:normal']):
-            node.style = "normal"
-
-        result.append(node)
-
-    for tree in result:
-        ignore_tree(tree, args)
-
-    return result
-
-
-def link_parent(parent: Node):
-    for child in parent.children:
-        child.parent = parent
-        link_parent(child)
+        (args.expert_mode and not IGNORE_ITEM_TAGS.isdisjoint(node.tags))
+
+def is_ignored_outline(node: Node, args: argparse.Namespace) -> bool:
+    '''This item is dropped together with its whole subtree.'''
+    return args.expert_mode and not IGNORE_OUTLINE_TAGS.isdisjoint(node.tags)
+
+def prune_nodes(nodes: List[Node], args: argparse.Namespace) -> List[Node]:
+    '''
+    Return the nodes that survive pruning, in order: ignored items are replaced
+    by their (pruned) children, ignored outlines are dropped.
+    Every node is looked at once, so this is linear in the number of nodes
+    visited, however wide the list.
+    '''
+    kept: List[Node] = []
+    pending = list(reversed(nodes))
+    while pending:
+        node = pending.pop()
+        if is_ignored_item(node, args):
+            pending.extend(reversed(node.children))
+        elif not is_ignored_outline(node, args):
+            kept.append(node)
+    return kept
 
 def print_forest(forest: List[Node]):
     for tree in forest:
@@ -343,33 +268,56 @@ def print_children(node:Node) -> str:
 
 # Issue 65 (enhancement): set styles to normal when required
 '''
-Walk the tree specified by node iteratively, doing preprocessing as needed.
-One day this might include the 'ignore' stuff.
+Preprocessing visitors: each stage is a function visit(node, args) called once for every node that
+survives pruning, in document order, during the single walk done by preprocess_forest.
+A visitor returns True to select node as the start of the conversion (see select_start).
+Register a new stage by adding it to PREPROCESS_VISITORS.
 '''
-def preprocess_tree(node: Node, args: argparse.Namespace):
-    nodeStack = [node]
+def set_style(node: Node, args: argparse.Namespace) -> bool:
+    if args.expert_mode and '#style:normal' in node.tags:
+        node.style = "normal"
+    return False
 
-    while nodeStack:
-        currentNode = nodeStack.pop()
-        
-        if args.expert_mode and any(tag in currentNode.title for tag in ['#style:normal']):
-            currentNode.style = "normal"
+def select_start(node: Node, args: argparse.Namespace) -> bool:
+    return bool(args.start) and node.title.startswith(args.start)
 
-        for child in reversed(currentNode.children):
-            nodeStack.append(child)
-    
-    return
+PREPROCESS_VISITORS = [set_style, select_start]
 
-# Issue 65 (enhancement): allow set style in trees to normal when required
 '''
-Preprocess all the trees in the forest
+Preprocess all the trees in the forest in one iterative walk: the roots and then every child list
+are pruned (completion filtering and ignore tags, see prune_nodes) as the walk reaches them, and the
+visitors are applied to the surviving nodes.
+Once a node is selected as the start item, the walk is restricted to its subtree and the returned
+forest is just that node.  If --start is given and nothing matches, the forest is empty.
 '''
-def preprocess_forest(forest: List[Node], args: argparse.Namespace):
-    retval = []
-    for oneTree in forest:
-        preprocess_tree(oneTree, args)
-        retval.append(oneTree)
+def preprocess_forest(forest: List[Node], args: argparse.Namespace, visitors=None) -> List[Node]:
+    if visitors is None:
+        visitors = PREPROCESS_VISITORS
+    retval = prune_nodes(forest, args)
+    for oneTree in retval:
+        oneTree.parent = None
+
+    start: Optional[Node] = None
+    nodeStack = list(reversed(retval))
+    while nodeStack:
+        currentNode = nodeStack.pop()
 
+        selected = False
+        for visit in visitors:
+            selected = visit(currentNode, args) or selected
+        if selected and start is None:
+            # forget the rest of the forest, only this subtree is converted
+            start = currentNode
+            nodeStack.clear()
+
+        if currentNode.children:
+            currentNode.children = prune_nodes(currentNode.children, args)
+            for child in currentNode.children:
+                child.parent = currentNode
+            nodeStack.extend(reversed(currentNode.children))
+
+    if start is not None:
+        return [start]
+    if args.start:
+        return []
     return retval
-
-
@@ -0,0 +1,35 @@
+'''
+Micro-benchmark of escape_latex against the chain of str.replace calls it replaced, on words of
+plain prose, words full of LaTeX specials and a mix of both.  Not collected by pytest; run with
+    python test/bench_escape_latex.py
+'''
+import os
+import random
+import sys
+import timeit
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'),
+                os.path.dirname(os.path.abspath(__file__))]
+
+from outline_convert.utils import escape_latex
+from test_escape_latex import SPECIALS, escape_latex_chain
+
+
+def corpora():
+    rng = random.Random(65)
+    prose = ('the quick brown fox jumps over the lazy dog while reading outlines about hyraxes '
+             'and their relation to other animals').split() * 1000
+    special = [''.join(rng.choice(SPECIALS + 'abxyz') for _ in range(8)) for _ in range(len(prose))]
+    mixed = [rng.choice(special) if rng.random() < 0.1 else word for word in prose]
+    return {'prose': prose, 'special': special, 'mixed 10%': mixed}
+
+
+def main():
+    for name, words in corpora().items():
+        for escape in (escape_latex_chain, escape_latex):
+            best = min(timeit.repeat(lambda: [escape(word) for word in words], number=5, repeat=5))
+            print(f"{name:10} {escape.__name__:20} {len(words) * 5 / best / 1e6:6.2f}M words/s")
+
+
+if __name__ == '__main__':
+    main()
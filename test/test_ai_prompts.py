@@ -0,0 +1,109 @@
+'''
+#ai-prompt items answered through a stand-in for the chat completions HTTP API, so that the
+concurrency of handle_ai_prompts is checked without a network or an API key.
+'''
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('openai')
+
+from outline_convert.main import add_conversion_arguments, handle_ai_prompts
+from outline_convert.parser import parse_text
+
+DELAY = 0.3
+
+
+class StandIn(BaseHTTPRequestHandler):
+    '''Answers every chat completion after DELAY seconds with "answer to <prompt>".'''
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    prompts = []
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = request['messages'][0]['content']
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            cls.prompts.append(prompt)
+        time.sleep(DELAY)
+        with cls.lock:
+            cls.in_flight -= 1
+        body = json.dumps({
+            'id': 'stand-in', 'object': 'chat.completion', 'created': 0, 'model': request['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': f"answer to {prompt.splitlines()[0]}"}}],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    StandIn.in_flight = StandIn.max_in_flight = 0
+    StandIn.prompts = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('OPENAI_BASE_URL', f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setenv('OPENAI_API_KEY', 'stand-in')
+    yield StandIn
+    server.shutdown()
+    server.server_close()
+
+
+def conversion_args(*argv):
+    p = argparse.ArgumentParser()
+    p.add_argument('-f', '--format', default='txt')
+    add_conversion_arguments(p)
+    return p.parse_args(['--no-ai-cache', *argv])
+
+
+def test_independent_prompts_are_sent_concurrently(stand_in):
+    lines = ['Deck'] + [f"  - question {i} #ai-prompt" for i in range(8)]
+    args = conversion_args('--ai-concurrency', '4')
+    start = time.perf_counter()
+    forest = handle_ai_prompts(parse_text(lines, args), args)
+    elapsed = time.perf_counter() - start
+
+    assert [child.title for child in forest[0].children] == \
+        [f"answer to question {i} #ai-prompt" for i in range(8)]
+    assert stand_in.max_in_flight == 4
+    # two rounds of 4, not 8 prompts one after the other
+    assert elapsed < 6 * DELAY
+
+
+def test_nested_prompt_is_sent_after_its_inner_prompts(stand_in):
+    lines = ['Deck',
+             '  - summarise #ai-prompt',
+             '    - part 1 #ai-prompt',
+             '      - notes 1',
+             '    - part 2 #ai-prompt',
+             '      - notes 2']
+    args = conversion_args('--ai-concurrency', '4')
+    forest = handle_ai_prompts(parse_text(lines, args), args)
+
+    [answer] = forest[0].children
+    assert answer.title.startswith('answer to summarise #ai-prompt')
+    assert len(stand_in.prompts) == 3
+    # the outer prompt carries the answers of the inner ones
+    assert 'answer to part 1 #ai-prompt' in stand_in.prompts[-1]
+    assert 'answer to part 2 #ai-prompt' in stand_in.prompts[-1]
+
+
+def test_ai_concurrency_must_be_positive():
+    with pytest.raises(SystemExit):
+        conversion_args('--ai-concurrency', '0')
@@ -0,0 +1,93 @@
+'''
+Very deep outlines: parsing, preprocessing and every renderer walk trees with explicit stacks,
+so a chain far deeper than the recursion limit must convert in every format.
+Indented formats write O(depth^2) characters, their chain is shallower.
+'''
+import argparse
+import io
+import sys
+
+import pytest
+
+from outline_convert.fragments import FRAGMENTS
+from outline_convert.main import add_conversion_arguments, convert_forest, render_forest
+from outline_convert.parser import parse_opml_stream, parse_text
+
+DEPTH = 100000
+INDENTED_DEPTH = 20000
+
+
+def chain_opml(depth):
+    return ('<?xml version="1.0"?><opml version="2.0"><head/><body>'
+            + ''.join(f'<outline text="item {i}">' for i in range(depth))
+            + '</outline>' * depth + '</body></opml>')
+
+
+def conversion_args(*argv):
+    p = argparse.ArgumentParser()
+    p.add_argument('-f', '--format', default='txt')
+    add_conversion_arguments(p)
+    return p.parse_args(['--fragment', *argv])
+
+
+def convert(text, *argv):
+    '''The number of output lines and the line of the deepest item, without keeping the output.'''
+    args = conversion_args(*argv)
+    forest = convert_forest(parse_opml_stream(io.StringIO(text), args=args), args)
+    count = 0
+    deepest = None
+    for line in render_forest(forest, args):
+        count += 1
+        if 'item' in line:
+            deepest = line
+    return count, deepest.strip()
+
+
+@pytest.fixture(autouse=True)
+def low_recursion_limit():
+    # any recursion over the depth of the outline fails long before the chain ends
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(1000)
+    yield
+    sys.setrecursionlimit(limit)
+
+
+@pytest.fixture(params=[False, True], ids=['plain', 'memoized'])
+def fragments(request):
+    enabled = FRAGMENTS.enabled
+    FRAGMENTS.enabled = request.param
+    yield
+    FRAGMENTS.enabled = enabled
+
+
+def test_txt(fragments):
+    count, deepest = convert(chain_opml(DEPTH), '-f', 'txt', '-t', '')
+    assert count == DEPTH
+    assert deepest == f"item {DEPTH - 1}"
+
+
+def test_opml(fragments):
+    count, deepest = convert(chain_opml(INDENTED_DEPTH), '-f', 'opml')
+    assert count > INDENTED_DEPTH
+    assert deepest == f'<outline text="item {INDENTED_DEPTH - 1}" />'
+
+
+def test_latex(fragments):
+    count, deepest = convert(chain_opml(INDENTED_DEPTH), '-f', 'latex')
+    assert count > INDENTED_DEPTH
+    assert deepest == rf"\item item {INDENTED_DEPTH - 1}"
+
+
+def test_beamer(fragments):
+    count, deepest = convert(chain_opml(INDENTED_DEPTH), '-f', 'beamer')
+    assert count > INDENTED_DEPTH
+    assert deepest == rf"\item item {INDENTED_DEPTH - 1}"
+
+
+def test_text_input(fragments):
+    lines = [' ' * depth + f"- item {depth}" for depth in range(INDENTED_DEPTH)]
+    args = conversion_args('-f', 'txt', '-t', '')
+    forest = convert_forest(parse_text(lines, args), args)
+    out = list(render_forest(forest, args))
+    assert len(out) == INDENTED_DEPTH
+    assert out[-1].strip() == f"item {INDENTED_DEPTH - 1}"
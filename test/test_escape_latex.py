@@ -0,0 +1,39 @@
+'''escape_latex must give exactly the output of the chain of str.replace calls it replaced.'''
+import random
+
+from outline_convert.utils import escape_latex
+
+SPECIALS = '\\&%$#_{}~^'
+
+
+def escape_latex_chain(text):
+    '''The former escape_latex: backslashes first, so the later escapes leave theirs alone.'''
+    return text.replace('\\', r'\textbackslash{}') \
+        .replace('&', r'\&') \
+        .replace('%', r'\%') \
+        .replace('$', r'\$') \
+        .replace('#', r'\#') \
+        .replace('_', r'\_') \
+        .replace('{', r'\{') \
+        .replace('}', r'\}') \
+        .replace('~', r'\textasciitilde{}') \
+        .replace('^', r'\textasciicircum{}')
+
+
+def test_every_special_character():
+    for c in SPECIALS:
+        assert escape_latex(c) == escape_latex_chain(c)
+    assert escape_latex('\\') == r'\textbackslash\{\}'
+
+
+def test_random_strings():
+    rng = random.Random(65)
+    alphabet = SPECIALS + 'ab é€'
+    for _ in range(20000):
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randrange(12)))
+        assert escape_latex(text) == escape_latex_chain(text)
+
+
+def test_plain_text_is_returned_as_is():
+    text = 'no special characters here'
+    assert escape_latex(text) is text
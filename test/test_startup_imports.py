@@ -0,0 +1,46 @@
+'''
+A plain text conversion must not pay for the optional dependencies and the other renderers:
+the CLI is often run in loops, see the imports of main.py.  Each check runs in a fresh interpreter.
+'''
+import os
+import subprocess
+import sys
+
+import outline_convert
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(outline_convert.__file__)))
+
+LAZY_MODULES = ['openai', 'pyperclip', 'zipfile', 'outline_convert.renderer_latex',
+                'outline_convert.query', 'outline_convert.cache']
+
+CONVERT = '''
+import sys
+sys.argv = ['outline-convert'] + sys.argv[1:]
+from outline_convert.main import main
+main()
+print(' '.join(name for name in {modules!r} if name in sys.modules), file=sys.stderr)
+'''
+
+
+def loaded_modules(tmp_path, *argv):
+    '''The LAZY_MODULES imported by a conversion run with argv, in a fresh interpreter.'''
+    env = dict(os.environ, PYTHONPATH=SRC, OUTLINE_CONVERT_CACHE=str(tmp_path / 'cache'))
+    result = subprocess.run([sys.executable, '-c', CONVERT.format(modules=LAZY_MODULES), *argv],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, check=True)
+    return result.stderr.split()
+
+
+def test_plain_text_conversion(tmp_path):
+    (tmp_path / 'a.txt').write_text('- a\n  - b #tag\n- c\n', encoding='utf-8')
+    assert loaded_modules(tmp_path, 'a.txt', '-o', 't.txt') == []
+    assert 'b #tag' in (tmp_path / 't.txt').read_text(encoding='utf-8')
+
+
+def test_plain_opml_output(tmp_path):
+    (tmp_path / 'a.txt').write_text('- a\n  - b\n', encoding='utf-8')
+    assert loaded_modules(tmp_path, 'a.txt', '-f', 'opml', '-o', 'a.opml') == []
+
+
+def test_query_is_imported_when_used(tmp_path):
+    (tmp_path / 'a.txt').write_text('- a\n  - b #tag\n', encoding='utf-8')
+    assert loaded_modules(tmp_path, 'a.txt', '-q', '#tag', '-o', 't.txt') == ['outline_convert.query']